@@ -0,0 +1,197 @@
+"""
+Packs the textures used by one plane into a few big atlas images, so the plane
+ends up with one textured material per atlas instead of one per texture.
+
+Only textures whose uvs stay inside the texture can go in an atlas, the ones
+which tile (uvs past 0..1) keep their own material.
+"""
+import io
+from zipfile import ZipFile
+
+from PIL import Image
+
+import materials
+
+DEFAULT_SIZE = 2048
+DEFAULT_PADDING = 4
+
+# uvs a tiny bit past the edge are just float noise, not tiling
+UV_TOLERANCE = 0.001
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--atlas",
+        action="store_true",
+        help="Pack each plane's textures into a few atlas images, with one material per atlas")
+    parser.add_argument(
+        "--atlas-size",
+        metavar="SIZE",
+        default=DEFAULT_SIZE,
+        type=int,
+        help=f"Largest width and height of an atlas image. Defaults to {DEFAULT_SIZE}")
+
+def to_args(args):
+    """Turn parsed arguments back into a command line, for passing on to the export scripts."""
+    res = []
+    if args.atlas:
+        res.append("--atlas")
+        if args.atlas_size != DEFAULT_SIZE:
+            res += ["--atlas-size", str(args.atlas_size)]
+    return res
+
+def mesh_indices(graph, root, skipped=(), emptied=()):
+    """The meshes which get built for the subtree under root."""
+    return [
+        graph.nodes[i]["mesh_index"] for i in graph.subtree(root, skip=lambda c: c in skipped)
+        if graph.nodes[i].get("mesh_index", -1) != -1 and i not in emptied
+    ]
+
+def uv_ranges(meshes_json, mesh_indices):
+    """The (min u, min v, max u, max v) each material is used with across these meshes."""
+    ranges = {}
+    for mesh_index in mesh_indices:
+        m = meshes_json[mesh_index]
+        if not m: continue
+        for poly in m["polygons"]:
+            mat = poly["materials"][0]
+            for uv in mat["uv_coords"] or []:
+                r = ranges.setdefault(mat["material_index"], [uv["u"], uv["v"], uv["u"], uv["v"]])
+                r[0] = min(r[0], uv["u"])
+                r[1] = min(r[1], uv["v"])
+                r[2] = max(r[2], uv["u"])
+                r[3] = max(r[3], uv["v"])
+    return ranges
+
+def pack(sizes, max_size, padding):
+    """
+    Shelf packing: tallest first, left to right along rows, starting a new atlas
+    when one fills up. sizes is {name: (w, h)}, each of which must fit in max_size
+    with its padding. Returns a list of (atlas size, {name: (x, y)}) where x, y is
+    the top left of the texture itself, inside its padding.
+    """
+    order = sorted(sizes, key=lambda name: (sizes[name][1], sizes[name][0]), reverse=True)
+
+    # make atlases about as wide as they are tall, but no wider than they need to be
+    area = sum((w + 2 * padding) * (h + 2 * padding) for w, h in sizes.values())
+    width = 1
+    while width * width < area and width < max_size:
+        width *= 2
+    width = max(width, max((w + 2 * padding for w, h in sizes.values()), default=0))
+    width = min(width, max_size)
+
+    atlases = []
+    placed = None
+    for name in order:
+        w, h = sizes[name]
+        w += 2 * padding
+        h += 2 * padding
+        if placed is not None and x + w > width:
+            # next shelf
+            y += shelf_height
+            x = 0
+            shelf_height = 0
+        if placed is None or y + h > max_size:
+            placed = {}
+            atlases.append(placed)
+            x = y = shelf_height = 0
+        placed[name] = (x + padding, y + padding)
+        x += w
+        shelf_height = max(shelf_height, h)
+
+    res = []
+    for placed in atlases:
+        height = max(py + sizes[name][1] + padding for name, (px, py) in placed.items())
+        # power of two heights play nicer with mipmaps
+        pow2 = 1
+        while pow2 < height:
+            pow2 *= 2
+        res.append(((width, min(pow2, max_size)), placed))
+    return res
+
+def paste_padded(atlas, im, x, y, padding):
+    """Paste im at x, y, and repeat its edge pixels into the padding so filtering doesn't bleed."""
+    w, h = im.size
+    atlas.paste(im, (x, y))
+    if not padding: return
+    atlas.paste(im.crop((0, 0, w, 1)).resize((w, padding)), (x, y - padding))
+    atlas.paste(im.crop((0, h - 1, w, h)).resize((w, padding)), (x, y + h))
+    atlas.paste(im.crop((0, 0, 1, h)).resize((padding, h)), (x - padding, y))
+    atlas.paste(im.crop((w - 1, 0, w, h)).resize((padding, h)), (x + w, y))
+    for cx, cy, px, py in [(0, 0, x - padding, y - padding), (w - 1, 0, x + w, y - padding),
+                           (0, h - 1, x - padding, y + h), (w - 1, h - 1, x + w, y + h)]:
+        atlas.paste(im.getpixel((cx, cy)), (px, py, px + padding, py + padding))
+
+
+class AtlasSet:
+    """
+    The atlases for one plane. Opaque and transparent textures go in separate
+    atlases, so only the transparent ones need alpha blending.
+    """
+    def __init__(self, atlases, rects, textures=()):
+        # [{"name", "image", "alpha"}]
+        self.atlases = atlases
+        # material index -> (atlas index, x, y, w, h)
+        self.rects = rects
+        # names of the textures which were packed
+        self.textures = set(textures)
+
+    @classmethod
+    def build(cls, textures_zip, materials_json, meshes_json, mesh_indices, substitutions,
+              max_size=DEFAULT_SIZE, padding=DEFAULT_PADDING, name="atlas"):
+        if not isinstance(textures_zip, ZipFile):
+            textures_zip = ZipFile(textures_zip)
+        names = set(textures_zip.namelist())
+
+        # which textures can go in, and which materials use them
+        texture_mats = {}
+        for mat_index, (u0, v0, u1, v1) in uv_ranges(meshes_json, mesh_indices).items():
+            if "Textured" not in materials_json[mat_index]: continue
+            if min(u0, v0) < -UV_TOLERANCE or max(u1, v1) > 1 + UV_TOLERANCE: continue
+            texture_name = materials.material_name(materials_json, mat_index, substitutions)
+            if texture_name in names:
+                texture_mats.setdefault(texture_name, []).append(mat_index)
+
+        images = {}
+        for texture_name in texture_mats:
+            with Image.open(io.BytesIO(textures_zip.read(texture_name))) as im:
+                im = im.convert("RGBA")
+            if max(im.size) + 2 * padding <= max_size:
+                images[texture_name] = im
+
+        atlases = []
+        rects = {}
+        packed = set()
+        for alpha in [False, True]:
+            group = {n: im for n, im in images.items() if (im.getextrema()[3][0] < 255) == alpha}
+            for size, placed in pack({n: im.size for n, im in group.items()}, max_size, padding):
+                image = Image.new("RGBA" if alpha else "RGB", size)
+                for texture_name, (x, y) in placed.items():
+                    im = group[texture_name]
+                    paste_padded(image, im if alpha else im.convert("RGB"), x, y, padding)
+                    packed.add(texture_name)
+                    for mat_index in texture_mats[texture_name]:
+                        rects[mat_index] = (len(atlases), x, y) + im.size
+                atlases.append({"name": f"{name}{len(atlases)}.png", "image": image, "alpha": alpha})
+
+        return cls(atlases, rects, packed)
+
+    def atlas_of(self, mat_index):
+        """The index of the atlas mat_index was packed into, or None."""
+        rect = self.rects.get(mat_index)
+        return rect[0] if rect else None
+
+    def remap_poly(self, poly):
+        """A copy of poly with its uvs moved into its atlas, or poly itself if it isn't in one."""
+        mat = poly["materials"][0]
+        rect = self.rects.get(mat["material_index"])
+        if rect is None: return poly
+        n, x, y, w, h = rect
+        width, height = self.atlases[n]["image"].size
+        uvs = [{"u": (x + uv["u"] * w) / width, "v": (y + uv["v"] * h) / height} for uv in mat["uv_coords"] or []]
+        return {**poly, "materials": [{**mat, "uv_coords": uvs}] + poly["materials"][1:]}
+
+    def png_bytes(self, n):
+        f = io.BytesIO()
+        self.atlases[n]["image"].save(f, format="png")
+        return f.getvalue()
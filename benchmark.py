@@ -0,0 +1,399 @@
+"""
+Times each stage of the pipeline on made-up data, so you don't need the game or blender.
+
+    > python benchmark.py --size medium --out baseline.json
+    > python benchmark.py --size medium --compare baseline.json
+"""
+import argparse
+import io
+import json
+import random
+import struct
+import subprocess
+import sys
+import time
+import zlib
+from pathlib import Path
+from tempfile import TemporaryDirectory
+from zipfile import ZipFile
+
+try:
+    from PIL import Image
+except ImportError:
+    print("This script requires pillow to work. Run pip install pillow!")
+    exit(1)
+
+import extract_bm
+import extract_rof
+import instrument
+import meshdata
+import prune
+import set_paintjob
+import tiling
+from nodegraph import NodeGraph
+from textures import aggregate_textures
+
+SIZES = {
+    "small": {
+        "rof_depth": 2, "rof_fanout": 3, "rof_files": 4, "rof_file_size": 4096,
+        "bm_count": 4, "bm_size": 64,
+        "texture_zips": 3, "textures_per_zip": 20, "texture_size": 32,
+        "nodes": 500, "meshes": 100, "mesh_verts": 50, "mesh_polys": 40, "materials": 20,
+    },
+    "medium": {
+        "rof_depth": 3, "rof_fanout": 4, "rof_files": 8, "rof_file_size": 16384,
+        "bm_count": 12, "bm_size": 256,
+        "texture_zips": 8, "textures_per_zip": 100, "texture_size": 64,
+        "nodes": 5000, "meshes": 1000, "mesh_verts": 100, "mesh_polys": 80, "materials": 100,
+    },
+    "large": {
+        "rof_depth": 4, "rof_fanout": 4, "rof_files": 16, "rof_file_size": 65536,
+        "bm_count": 24, "bm_size": 512,
+        "texture_zips": 12, "textures_per_zip": 300, "texture_size": 128,
+        "nodes": 40000, "meshes": 8000, "mesh_verts": 150, "mesh_polys": 120, "materials": 300,
+    },
+}
+
+# changes smaller than these are noise, however big they are in percent
+MIN_SECONDS = 0.005
+MIN_BYTES = 4 * 2**20
+
+
+def make_rof(path, rng, depth, fanout, files, file_size):
+    """Write a .rof with nested directories and a mix of compressed and stored files."""
+    def make_dir(level):
+        children = []
+        for i in range(files):
+            data = rng.randbytes(file_size // 2) + bytes(file_size // 2)
+            compressed = i % 2 == 0
+            children.append({
+                "name": f"FILE{i}.DAT",
+                "is_dir": False,
+                "is_compressed": compressed,
+                "data": zlib.compress(data) if compressed else data,
+            })
+        if level < depth:
+            for i in range(fanout):
+                children.append({"name": f"DIR{i}", "is_dir": True, "children": make_dir(level + 1)})
+        return children
+
+    root = {"name": "root", "is_dir": True, "children": make_dir(1)}
+
+    # lay everything out one after the other, directories first so their offsets are known
+    entries = [root]
+    offset = 0
+    for entry in entries:
+        entry["start"] = offset
+        if entry["is_dir"]:
+            entry["names"] = b"".join(c["name"].encode() + b"\x00" for c in entry["children"])
+            offset += 8 + 24 * len(entry["children"]) + len(entry["names"])
+            entries.extend(entry["children"])
+        else:
+            offset += len(entry["data"])
+
+    with open(path, "wb") as f:
+        for entry in entries:
+            if entry["is_dir"]:
+                f.write(struct.pack("<II", len(entry["children"]), len(entry["names"])))
+                for c in entry["children"]:
+                    length = 0 if c["is_dir"] else len(c["data"])
+                    flags = (extract_rof.IS_DIR_FLAG if c["is_dir"] else 0) | \
+                        (extract_rof.IS_COMPRESSED_FLAG if c.get("is_compressed") else 0)
+                    f.write(struct.pack("<IIIIII", c["start"], length, length, flags, len(c["name"]) + 1, 0))
+                f.write(entry["names"])
+            else:
+                f.write(entry["data"])
+
+def make_bm(path, rng, size):
+    with open(path, "wb") as f:
+        f.write(struct.pack("<HH", size, size))
+        f.write(rng.randbytes(size * size * 3))
+        for _ in range(3):
+            f.write(rng.randbytes(size * size))
+        f.write(rng.randbytes(size * size * 4))
+
+def make_png(rng, size, mode):
+    im = Image.frombytes(mode, (size, size), rng.randbytes(size * size * len(mode)))
+    buf = io.BytesIO()
+    im.save(buf, format="png")
+    return buf.getvalue()
+
+def make_texture_zips(folder, rng, count, per_zip, size):
+    """Texture zips like unzbd's, where each one shares half its textures with the one before."""
+    paths = []
+    for z in range(count):
+        path = folder / f"c{z}_textures.zip"
+        with ZipFile(path, "w") as f:
+            for t in range(per_zip):
+                f.writestr(f"tex{z * per_zip // 2 + t:05}.png", make_png(rng, size, "RGB"))
+        paths.append(path)
+    return paths
+
+def make_gamez(path, rng, nodes, meshes, mesh_verts, mesh_polys, materials):
+    """A zip with meshes.json, nodes.json and materials.json, like unzbd makes from a gamez.zbd."""
+    def color():
+        return {"r": rng.randrange(256), "g": rng.randrange(256), "b": rng.randrange(256)}
+
+    materials_json = []
+    for i in range(materials):
+        if i % 4 == 0:
+            materials_json.append({"Colored": {"color": color()}})
+        else:
+            materials_json.append({"Textured": {"texture": f"tex{i:05}.tif"}})
+
+    meshes_json = []
+    for _ in range(meshes):
+        vertices = [{"x": rng.uniform(-10, 10), "y": rng.uniform(-10, 10), "z": rng.uniform(-10, 10)} for _ in range(mesh_verts)]
+        polygons = []
+        for p in range(mesh_polys):
+            n = rng.randrange(3, 9)
+            vertex_indices = [rng.randrange(mesh_verts) for _ in range(n)]
+            polygons.append({
+                "flags": ["triangle_strip"] if p % 2 else [],
+                "vertex_indices": vertex_indices,
+                "vertex_colors": [color() for _ in range(n)],
+                "materials": [{
+                    "material_index": rng.randrange(materials),
+                    "uv_coords": [{"u": rng.random(), "v": rng.random()} for _ in range(n)],
+                }],
+            })
+        meshes_json.append({"vertices": vertices, "polygons": polygons})
+
+    # a world with terrain hanging off it, some of it detached, and a few misc trees
+    nodes_json = [{"World": {"name": "world", "parent": None, "children": [], "transformation": None}}]
+    for i in range(1, nodes):
+        parent = 0 if i < nodes // 4 else (None if i % 50 == 0 else rng.randrange(max(1, i - 20), i))
+        node_type = "Terrain" if parent == 0 else ("Lod" if i % 7 == 0 else "Object3d")
+        nodes_json.append({node_type: {
+            "name": ["nearest", "far", "shadow", "static", "body"][i % 5],
+            "parent": parent,
+            "children": [],
+            "mesh_index": rng.randrange(meshes) if i % 3 else -1,
+            "transformation": {
+                "translation": {"x": rng.uniform(-1000, 1000), "y": rng.uniform(-10, 10), "z": rng.uniform(-1000, 1000)},
+                "rotation": {"x": rng.uniform(-3, 3), "y": rng.uniform(-3, 3), "z": rng.uniform(-3, 3)},
+            },
+        }})
+    for i, n in enumerate(nodes_json):
+        parent = next(iter(n.values()))["parent"]
+        # leave some terrain out of the world's children, like the real thing
+        if parent is not None and not (parent == 0 and i % 2):
+            next(iter(nodes_json[parent].values()))["children"].append(i)
+
+    with ZipFile(path, "w") as f:
+        f.writestr("meshes.json", json.dumps(meshes_json))
+        f.writestr("nodes.json", json.dumps(nodes_json))
+        f.writestr("materials.json", json.dumps(materials_json))
+
+
+def make_data(folder, size):
+    """Write all the made-up input files into folder."""
+    rng = random.Random(0)
+    make_rof(folder / "crimson.rof", rng, size["rof_depth"], size["rof_fanout"], size["rof_files"], size["rof_file_size"])
+
+    bm_folder = folder / "bm"
+    bm_folder.mkdir()
+    for i in range(size["bm_count"]):
+        make_bm(bm_folder / f"FUR_PART{i}.bm", rng, size["bm_size"])
+
+    make_texture_zips(folder, rng, size["texture_zips"], size["textures_per_zip"], size["texture_size"])
+    make_gamez(folder / "c1.zip", rng, size["nodes"], size["meshes"], size["mesh_verts"], size["mesh_polys"], size["materials"])
+
+def stages(folder):
+    """
+    Returns (name, setup, run) for each stage, working on the files make_data
+    wrote. setup makes fresh inputs, run is what gets timed.
+    """
+    rof_path = folder / "crimson.rof"
+    bm_paths = sorted((folder / "bm").glob("*.bm"))
+    zip_paths = sorted(folder.glob("c*_textures.zip"), key=lambda path: int(path.name[1:].split("_")[0]))
+    gamez_path = folder / "c1.zip"
+
+    def parse_rof():
+        with open(rof_path, "rb") as f:
+            root = {"start": 0, "name": "rof_output", "is_dir": True}
+            extract_rof.parse_entry(root, f)
+        return root
+
+    def extract_rof_setup():
+        out = folder / f"rof_{time.perf_counter_ns()}"
+        out.mkdir()
+        return out, parse_rof()
+
+    def extract_rof_run(state):
+        out, root = state
+        with open(rof_path, "rb") as f:
+            extract_rof.write_tree_to_disk(root, out, f)
+
+    def decode_bm():
+        for path in bm_paths:
+            extract_bm.convert_bm(path)
+
+    def paintjob():
+        for path in bm_paths:
+            set_paintjob.paint_texture(path, set_paintjob.FACTION_COLORS["STUDIO"])
+
+    def load_gamez():
+        with ZipFile(gamez_path) as gamez:
+            return {name: json.loads(gamez.read(name)) for name in ["meshes.json", "nodes.json", "materials.json"]}
+
+    def mesh_arrays(gamez):
+        for mesh in gamez["meshes.json"]:
+            meshdata.mesh_to_arrays(mesh)
+
+    def mesh_weld(gamez):
+        for mesh in gamez["meshes.json"]:
+            meshdata.mesh_to_arrays(mesh, 0.0001)
+
+    def node_graph(gamez):
+        graph = NodeGraph(gamez["nodes.json"])
+        prune.PrunePolicy("nearest", ["shadow"]).apply(graph)
+        tiling.compute_tiles(graph, gamez["meshes.json"], 100)
+
+    return [
+        ("rof_parse", lambda: None, lambda _: parse_rof()),
+        ("rof_extract", extract_rof_setup, extract_rof_run),
+        ("bm_decode", lambda: None, lambda _: decode_bm()),
+        # needs the pngs from bm_decode
+        ("paintjob", lambda: None, lambda _: paintjob()),
+        ("texture_aggregation", lambda: folder / f"agg_{time.perf_counter_ns()}.zip", lambda path: aggregate_textures(zip_paths, path)),
+        ("gamez_json", lambda: None, lambda _: load_gamez()),
+        ("mesh_arrays", load_gamez, mesh_arrays),
+        ("mesh_weld", load_gamez, mesh_weld),
+        ("node_graph", load_gamez, node_graph),
+    ]
+
+def measure(folder, name, setup, run, repeat):
+    """
+    Best wall time out of repeat runs, then the peak memory of a fresh process
+    running the stage once more. A separate process so the stages before it
+    don't count, and the peak is the whole process's since tracemalloc can't
+    see what pillow allocates.
+    """
+    times = []
+    for _ in range(repeat):
+        state = setup()
+        start = time.perf_counter()
+        run(state)
+        times.append(time.perf_counter() - start)
+
+    out = subprocess.run(
+        [sys.executable, __file__, "--peak-memory", name, "--data", str(folder)],
+        capture_output=True, text=True, check=True).stdout
+    peak = json.loads(out.splitlines()[-1])
+    return {"seconds": min(times), "peak_bytes": peak}
+
+def peak_memory(folder, name):
+    """Run one stage by itself and return this process's peak memory."""
+    for stage_name, setup, run in stages(folder):
+        if stage_name == name:
+            run(setup())
+    return instrument.memory_usage(peak=True)
+
+def compare(results, baseline, threshold, min_seconds=MIN_SECONDS):
+    """Print how each stage did against the baseline, and return whether any got worse."""
+    regressed = False
+    print(f"{'stage':<22}{'baseline':>12}{'now':>12}{'change':>10}")
+    for name, res in results["stages"].items():
+        if name not in baseline["stages"]:
+            print(f"{name:<22}{'-':>12}{res['seconds']:>11.4f}s{'new':>10}")
+            continue
+        old = baseline["stages"][name]
+        change = res["seconds"] / old["seconds"] - 1 if old["seconds"] else 0
+        flag = ""
+        if change > threshold and res["seconds"] - old["seconds"] > min_seconds:
+            flag = "  REGRESSION"
+            regressed = True
+        if (old["peak_bytes"] and res["peak_bytes"] and res["peak_bytes"] / old["peak_bytes"] - 1 > threshold and
+                res["peak_bytes"] - old["peak_bytes"] > MIN_BYTES):
+            flag += "  MEMORY REGRESSION"
+            regressed = True
+        print(f"{name:<22}{old['seconds']:>11.4f}s{res['seconds']:>11.4f}s{change:>+10.1%}{flag}")
+    return regressed
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline stages on synthetic data.")
+    parser.add_argument(
+        "--size",
+        default="small",
+        choices=SIZES.keys(),
+        help="How much data to generate. Defaults to small")
+    parser.add_argument(
+        "--set",
+        metavar="KEY=N",
+        action="append",
+        default=[],
+        help=f"Override one of the sizes: {', '.join(SIZES['small'].keys())}")
+    parser.add_argument(
+        "--stages",
+        metavar="NAMES",
+        type=lambda value: value.split(","),
+        help="Comma-separated stages to run. Defaults to all of them")
+    parser.add_argument(
+        "--repeat",
+        metavar="N",
+        default=5,
+        type=int,
+        help="Runs per stage, the best one counts. Defaults to 5")
+    parser.add_argument(
+        "--out",
+        metavar="FILE",
+        type=Path,
+        help="Save the results as json, to use as a baseline")
+    parser.add_argument(
+        "--compare",
+        metavar="FILE",
+        type=Path,
+        help="Compare the results against a baseline, exiting with 1 on regressions")
+    parser.add_argument(
+        "--threshold",
+        default=0.1,
+        type=float,
+        help="How much slower or bigger a stage can get before it counts as a regression. Defaults to 0.1")
+    parser.add_argument(
+        "--min-seconds",
+        default=MIN_SECONDS,
+        type=float,
+        help=f"How many seconds slower a stage has to get as well, so tiny stages don't flag on noise. Defaults to {MIN_SECONDS}")
+    # for measuring one stage's memory in its own process
+    parser.add_argument("--peak-memory", metavar="STAGE", help=argparse.SUPPRESS)
+    parser.add_argument("--data", type=Path, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.peak_memory:
+        print(json.dumps(peak_memory(args.data, args.peak_memory)))
+        exit(0)
+
+    size = dict(SIZES[args.size])
+    for override in args.set:
+        key, _, value = override.partition("=")
+        if key not in size:
+            print(f"ERROR: no such size {key}")
+            exit(1)
+        size[key] = int(value)
+
+    results = {"size": size, "python": sys.version.split()[0], "stages": {}}
+    with TemporaryDirectory() as tempdir:
+        make_data(Path(tempdir), size)
+        for name, setup, run in stages(Path(tempdir)):
+            if args.stages and name not in args.stages:
+                # paintjob needs the pngs bm_decode makes
+                if name == "bm_decode" and "paintjob" in args.stages:
+                    run(setup())
+                continue
+            res = measure(Path(tempdir), name, setup, run, args.repeat)
+            results["stages"][name] = res
+            peak = f"{res['peak_bytes'] / 2**20:>10.1f} MiB" if res["peak_bytes"] is not None else f"{'?':>14}"
+            print(f"{name:<22}{res['seconds']:>10.4f}s{peak}")
+
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print()
+        if compare(results, baseline, args.threshold, args.min_seconds):
+            exit(1)
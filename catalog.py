@@ -0,0 +1,373 @@
+"""
+An SQLite catalog of crimson.rof and the unzbd output, for finding out what
+uses what without unzipping and grepping json by hand.
+
+    > python catalog.py build
+    > python catalog.py texture "fur_*"
+    > python catalog.py mesh 12 --source planes.zip
+    > python catalog.py faction studio
+
+Building again only re-indexes files which changed since last time.
+"""
+import argparse
+import hashlib
+import io
+import json
+import sqlite3
+import zlib
+from pathlib import Path
+from zipfile import ZipFile
+
+from PIL import Image
+
+import extract_rof
+import materials
+import set_paintjob
+from nodegraph import NodeGraph
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    source TEXT PRIMARY KEY,
+    path TEXT,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE TABLE IF NOT EXISTS rof_entries (
+    source TEXT,
+    path TEXT,
+    name TEXT,
+    size INTEGER,
+    size_on_disk INTEGER,
+    compressed INTEGER,
+    sha1 TEXT,
+    -- for .bm files in a faction's folder, and the texture they paint
+    faction TEXT,
+    texture TEXT
+);
+CREATE TABLE IF NOT EXISTS textures (
+    source TEXT,
+    name TEXT,
+    size INTEGER,
+    sha1 TEXT,
+    width INTEGER,
+    height INTEGER,
+    mode TEXT
+);
+CREATE TABLE IF NOT EXISTS nodes (
+    source TEXT,
+    idx INTEGER,
+    name TEXT,
+    type TEXT,
+    parent INTEGER,
+    -- the top of the tree this node is in, e.g. the plane it's part of
+    root INTEGER,
+    mesh_index INTEGER
+);
+CREATE TABLE IF NOT EXISTS meshes (
+    source TEXT,
+    idx INTEGER,
+    vertices INTEGER,
+    polygons INTEGER
+);
+CREATE TABLE IF NOT EXISTS mesh_materials (
+    source TEXT,
+    mesh_index INTEGER,
+    material_index INTEGER
+);
+CREATE TABLE IF NOT EXISTS materials (
+    source TEXT,
+    idx INTEGER,
+    kind TEXT,
+    -- the png in textures.zip, after substitutions
+    texture TEXT,
+    color TEXT
+);
+CREATE INDEX IF NOT EXISTS rof_entries_texture ON rof_entries (texture);
+CREATE INDEX IF NOT EXISTS rof_entries_faction ON rof_entries (faction);
+CREATE INDEX IF NOT EXISTS textures_name ON textures (name);
+CREATE INDEX IF NOT EXISTS nodes_source_idx ON nodes (source, idx);
+CREATE INDEX IF NOT EXISTS nodes_name ON nodes (name);
+CREATE INDEX IF NOT EXISTS nodes_mesh ON nodes (source, mesh_index);
+CREATE INDEX IF NOT EXISTS mesh_materials_material ON mesh_materials (source, material_index);
+CREATE INDEX IF NOT EXISTS materials_texture ON materials (texture);
+"""
+
+TABLES = ["rof_entries", "textures", "nodes", "meshes", "mesh_materials", "materials"]
+
+
+def connect(path):
+    db = sqlite3.connect(str(path))
+    db.executescript(SCHEMA)
+    return db
+
+def is_current(db, source, path):
+    stat = path.stat()
+    row = db.execute("SELECT size, mtime_ns FROM sources WHERE source = ?", (source,)).fetchone()
+    return row == (stat.st_size, stat.st_mtime_ns)
+
+def forget(db, source):
+    for table in TABLES + ["sources"]:
+        db.execute(f"DELETE FROM {table} WHERE source = ?", (source,))
+
+def remember(db, source, path):
+    stat = path.stat()
+    db.execute("INSERT INTO sources VALUES (?, ?, ?, ?)", (source, str(path), stat.st_size, stat.st_mtime_ns))
+
+def index_rof(db, source, rof_path):
+    with open(rof_path, "rb") as f:
+        root = {"start": 0, "name": "", "is_dir": True}
+        extract_rof.parse_entry(root, f)
+
+        rows = []
+        stack = [(root, [])]
+        while stack:
+            entry, parts = stack.pop()
+            if entry["is_dir"]:
+                for child in entry["children"]:
+                    stack.append((child, parts + [child["name"]]))
+                continue
+
+            f.seek(entry["start"])
+            data = f.read(entry["length"])
+            if entry["is_compressed"]:
+                data = zlib.decompress(data)
+
+            faction = texture = None
+            if entry["name"].lower().endswith(".bm") and len(parts) > 3 and parts[:2] == ["ASSETS", "GRAPHICS"]:
+                faction = parts[2]
+                texture = set_paintjob.texture_name(Path(entry["name"]))
+            rows.append((
+                source, "/".join(parts), entry["name"], len(data), entry["length_on_disk"],
+                entry["is_compressed"], hashlib.sha1(data).hexdigest(), faction, texture,
+            ))
+    db.executemany("INSERT INTO rof_entries VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+def index_textures(db, source, zip_path):
+    rows = []
+    with ZipFile(zip_path) as z:
+        for name in z.namelist():
+            data = z.read(name)
+            try:
+                with Image.open(io.BytesIO(data)) as im:
+                    width, height, mode = im.width, im.height, im.mode
+            except OSError:
+                width = height = mode = None
+            rows.append((source, name, len(data), hashlib.sha1(data).hexdigest(), width, height, mode))
+    db.executemany("INSERT INTO textures VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+def index_gamez(db, source, zip_path, substitutions):
+    with ZipFile(zip_path) as gamez:
+        with gamez.open("meshes.json") as f:
+            meshes_json = json.load(f)
+        with gamez.open("materials.json") as f:
+            materials_json = json.load(f)
+        with gamez.open("nodes.json") as f:
+            graph = NodeGraph(json.load(f))
+
+    roots = [None] * len(graph)
+    for i in range(len(graph)):
+        # follow parents up, remembering the root for everything on the way
+        chain = []
+        j = i
+        while roots[j] is None and graph.parents[j] is not None:
+            chain.append(j)
+            j = graph.parents[j]
+        root = roots[j] if roots[j] is not None else j
+        for k in chain + [j]:
+            roots[k] = root
+
+    db.executemany("INSERT INTO nodes VALUES (?, ?, ?, ?, ?, ?, ?)", (
+        (source, i, graph.names[i], graph.types[i], graph.parents[i], roots[i], graph.nodes[i].get("mesh_index"))
+        for i in range(len(graph))
+    ))
+
+    mesh_rows = []
+    mesh_material_rows = []
+    for i, m in enumerate(meshes_json):
+        if not m: continue
+        mesh_rows.append((source, i, len(m["vertices"]), len(m["polygons"])))
+        for mat_index in sorted({p["materials"][0]["material_index"] for p in m["polygons"]}):
+            mesh_material_rows.append((source, i, mat_index))
+    db.executemany("INSERT INTO meshes VALUES (?, ?, ?, ?)", mesh_rows)
+    db.executemany("INSERT INTO mesh_materials VALUES (?, ?, ?)", mesh_material_rows)
+
+    material_rows = []
+    for i, m in enumerate(materials_json):
+        if "Colored" in m:
+            c = m["Colored"]["color"]
+            material_rows.append((source, i, "Colored", None, f"#{c['r']:02X}{c['g']:02X}{c['b']:02X}"))
+        else:
+            material_rows.append((source, i, "Textured", materials.material_name(materials_json, i, substitutions), None))
+    db.executemany("INSERT INTO materials VALUES (?, ?, ?, ?, ?)", material_rows)
+
+def build(db, unzbd_dir, rof_path, force=False):
+    """Index everything that changed, returning the sources which were (re)indexed."""
+    jobs = []
+    if rof_path is not None and rof_path.is_file():
+        jobs.append(("crimson.rof", rof_path, lambda s, p: index_rof(db, s, p)))
+    else:
+        print(f"WARNING: no crimson.rof at {rof_path}, skipping it")
+
+    for path in sorted(unzbd_dir.glob("*.zip")):
+        if path.name == "textures.zip" or path.name.endswith("_textures.zip"):
+            jobs.append((path.name, path, lambda s, p: index_textures(db, s, p)))
+        elif path.name == "planes.zip":
+            jobs.append((path.name, path, lambda s, p: index_gamez(db, s, p, materials.PLANE_TEXTURE_SUBSTITUTIONS)))
+        elif path.stem.startswith("c"):
+            jobs.append((path.name, path, lambda s, p: index_gamez(db, s, p, materials.LEVEL_TEXTURE_SUBSTITUTIONS)))
+
+    indexed = []
+    for source, path, index in jobs:
+        if not force and is_current(db, source, path): continue
+        print(f"Indexing {source}...")
+        with db:
+            forget(db, source)
+            index(source, path)
+            remember(db, source, path)
+        indexed.append(source)
+
+    # drop whatever isn't there any more
+    known = {source for source, _, _ in jobs}
+    with db:
+        for (source,) in db.execute("SELECT source FROM sources").fetchall():
+            if source not in known:
+                forget(db, source)
+    return indexed
+
+
+QUERIES = {
+    "texture": [
+        ("Used by", """
+            SELECT DISTINCT m.texture, m.source, r.name
+            FROM materials m
+            JOIN mesh_materials mm ON mm.source = m.source AND mm.material_index = m.idx
+            JOIN nodes n ON n.source = m.source AND n.mesh_index = mm.mesh_index
+            JOIN nodes r ON r.source = n.source AND r.idx = n.root
+            WHERE m.texture GLOB ?
+            ORDER BY 1, 2, 3"""),
+        ("Found in", """
+            SELECT name, source, size, width, height, mode, sha1
+            FROM textures WHERE name GLOB ?
+            ORDER BY 1, 2"""),
+        ("Painted from", """
+            SELECT texture, faction, path
+            FROM rof_entries WHERE texture GLOB ?
+            ORDER BY 1, 2"""),
+    ],
+    "mesh": [
+        ("Used by", """
+            SELECT n.source, n.idx, n.name, r.name, r.idx
+            FROM nodes n
+            JOIN nodes r ON r.source = n.source AND r.idx = n.root
+            WHERE n.mesh_index = ? AND n.source GLOB ?
+            ORDER BY 1, 2"""),
+        ("Materials", """
+            SELECT mm.source, m.idx, m.kind, COALESCE(m.texture, m.color)
+            FROM mesh_materials mm
+            JOIN materials m ON m.source = mm.source AND m.idx = mm.material_index
+            WHERE mm.mesh_index = ? AND mm.source GLOB ?
+            ORDER BY 1, 2"""),
+    ],
+    "node": [
+        ("Nodes", """
+            SELECT n.source, n.idx, n.name, n.type, n.mesh_index, r.name
+            FROM nodes n
+            JOIN nodes r ON r.source = n.source AND r.idx = n.root
+            WHERE n.name GLOB ? AND n.source GLOB ?
+            ORDER BY 1, 2"""),
+    ],
+    "faction": [
+        ("Provides", """
+            SELECT path, size, texture
+            FROM rof_entries WHERE faction = ? AND texture IS NOT NULL
+            ORDER BY 1"""),
+    ],
+}
+
+def print_rows(title, rows):
+    print(f"{title}:")
+    if not rows:
+        print("    nothing")
+    for row in rows:
+        print("    " + "\t".join("" if v is None else str(v) for v in row))
+
+def query(db, kind, params):
+    for title, sql in QUERIES[kind]:
+        print_rows(title, db.execute(sql, params[:sql.count("?")]).fetchall())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index crimson.rof and the unzbd output into SQLite, and look things up in it.")
+    parser.add_argument(
+        "--data",
+        metavar="FOLDER",
+        dest="data_dir",
+        default=Path("data"),
+        type=Path,
+        help="Folder with intermediate data. Defaults to ./data")
+    parser.add_argument(
+        "--db",
+        metavar="FILE",
+        type=Path,
+        help="Catalog database. Defaults to catalog.sqlite in the data folder")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build_parser = commands.add_parser("build", help="Index everything which changed since the last build")
+    build_parser.add_argument(
+        "--rof",
+        metavar="FILE",
+        default=Path(extract_rof.ROF_PATH),
+        type=Path,
+        help="Path to crimson.rof")
+    build_parser.add_argument("--force", action="store_true", help="Index everything again")
+
+    texture_parser = commands.add_parser("texture", help="Which planes and chapters use a texture, and where it comes from")
+    texture_parser.add_argument("pattern", help="Texture name or glob, e.g. fur_*")
+
+    mesh_parser = commands.add_parser("mesh", help="Which nodes use a mesh, and its materials")
+    mesh_parser.add_argument("index", type=int)
+    mesh_parser.add_argument("--source", default="*", help="Only look in this zip, e.g. planes.zip")
+
+    node_parser = commands.add_parser("node", help="Find nodes by name, and which plane or chapter they're in")
+    node_parser.add_argument("pattern", help="Node name or glob")
+    node_parser.add_argument("--source", default="*", help="Only look in this zip, e.g. c2b.zip")
+
+    faction_parser = commands.add_parser("faction", help="Which .bm textures a faction provides")
+    faction_parser.add_argument("faction", type=lambda value: value.upper())
+
+    sql_parser = commands.add_parser("sql", help="Run any query")
+    sql_parser.add_argument("sql")
+
+    args = parser.parse_args()
+    db_path = args.db or args.data_dir / "catalog.sqlite"
+
+    if args.command == "build":
+        unzbd_dir = args.data_dir / "unzbd_output"
+        if not unzbd_dir.is_dir():
+            print(f"ERROR: couldn't find unzbd output at {unzbd_dir}")
+            exit(1)
+        db = connect(db_path)
+        indexed = build(db, unzbd_dir, args.rof, args.force)
+        print(f"Indexed {len(indexed)} files into {db_path}")
+        exit(0)
+
+    if not db_path.is_file():
+        print(f"ERROR: no catalog at {db_path}. Run python catalog.py build first")
+        exit(1)
+    db = connect(db_path)
+
+    if args.command == "texture":
+        query(db, "texture", [args.pattern])
+    elif args.command == "mesh":
+        query(db, "mesh", [args.index, args.source])
+    elif args.command == "node":
+        query(db, "node", [args.pattern, args.source])
+    elif args.command == "faction":
+        query(db, "faction", [args.faction])
+    else:
+        try:
+            cursor = db.execute(args.sql)
+        except sqlite3.Error as e:
+            print(f"ERROR: {e}")
+            exit(1)
+        print_rows("Rows", cursor.fetchall())
@@ -1,7 +1,10 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import fnmatch
 import json
 from pathlib import Path
 import subprocess as sub
+import sys
 import urllib.request
 from zipfile import ZipFile
 
@@ -9,6 +12,16 @@ try:
     import PIL
 except ImportError:
     print("This script requires pillow to work. Run pip install pillow!")
+    exit(1)
+
+import atlas
+import instrument
+import materials
+import meshdata
+from nodegraph import NodeGraph
+import prune
+import textures
+import tiling
 
 DEFAULT_BLENDER_LOCATION = r"C:\Program Files\Blender Foundation\Blender 3.5\blender.exe"
 DEFAULT_CS_LOCATION = r"C:\Program Files (x86)\Microsoft Games\Crimson Skies"
@@ -64,6 +77,58 @@ parser.add_argument(
     "--skip-levels",
     action="store_true",
     help="Don't generate .blends for levels")
+parser.add_argument(
+    "--planes",
+    metavar="NAMES",
+    type=lambda value: [name for name in value.split(",") if name],
+    help="Comma-separated plane names or globs to generate, e.g. devastator,fur*. Skips levels unless --levels is given too")
+parser.add_argument(
+    "--levels",
+    metavar="NAMES",
+    type=lambda value: [name for name in value.split(",") if name],
+    help="Comma-separated chapter names or globs to generate, e.g. c2b. Skips planes unless --planes is given too")
+parser.add_argument(
+    "--tile-size",
+    metavar="SIZE",
+    type=float,
+    help="Split level .blends into a grid of tiles this many blender units across")
+parser.add_argument(
+    "--tile-files",
+    action="store_true",
+    help="Save each tile to its own .blend instead of one collection per tile")
+parser.add_argument(
+    "--jobs",
+    metavar="N",
+    default=1,
+    type=int,
+    help="Number of exports to run at once. Defaults to 1")
+parser.add_argument(
+    "--format",
+    choices=["blend", "glb"],
+    default="blend",
+    help="Save .blend files with blender, or .glb files without it. Defaults to blend")
+parser.add_argument(
+    "--batch",
+    action="store_true",
+    help="Merge static level meshes into one mesh per material")
+parser.add_argument(
+    "--stream",
+    metavar="MB",
+    type=int,
+    help="Keep each level build under about this many megabytes, by saving parts of it to their own .blends as they're finished")
+prune.add_arguments(parser)
+textures.add_arguments(parser)
+meshdata.add_arguments(parser)
+atlas.add_arguments(parser)
+parser.add_argument(
+    "--paint",
+    metavar="FACTION",
+    help="Paint planes with this faction's colors in shader nodes, so they can be changed in blender. Needs extract_rof.py and extract_bm.py run first")
+parser.add_argument(
+    "--report",
+    metavar="FILE",
+    type=lambda value: Path(value).resolve(),
+    help="Save a report of how long everything took to this json file")
 
 try:
     args = parser.parse_args()
@@ -79,10 +144,91 @@ unzbd_dir.mkdir(exist_ok=True)
 if not args.cs.is_dir():
     print(f"ERROR: No CS installation directory present at {args.cs.resolve()}. Install the game or specify another location with --cs")
 
-if not args.blender.is_file():
+if args.format == "blend" and not args.blender.is_file():
     print(f"ERROR: No blender executable present at {args.blender}. Install blender or specify another location with --blender")
     exit(1)
 
+if args.format == "glb" and (args.tile_size is not None or args.batch or args.paint or args.stream is not None):
+    print("ERROR: --tile-size, --batch, --paint and --stream only work with --format blend")
+    exit(1)
+
+if args.tile_files and args.tile_size is None:
+    print("ERROR: --tile-files needs --tile-size")
+    exit(1)
+
+# picking some planes or levels means not doing the other kind unless it's picked too
+if args.planes is not None or args.levels is not None:
+    args.skip_planes = args.skip_planes or args.planes is None
+    args.skip_levels = args.skip_levels or args.levels is None
+
+def selected(name, patterns):
+    return patterns is None or any(fnmatch.fnmatch(name.lower(), p.lower()) for p in patterns)
+
+chapters = [] if args.skip_levels else [c for c in CHAPTERS if selected(c, args.levels)]
+if not args.skip_levels and not chapters:
+    print(f"ERROR: No chapters match {','.join(args.levels)}. Chapters are {', '.join(CHAPTERS)}")
+    exit(1)
+
+def selected_planes(graph):
+    roots = [i for i in graph.roots if selected(graph.names[i], args.planes)]
+    if not roots:
+        print(f"ERROR: No planes match {','.join(args.planes)}. Planes are {', '.join(graph.names[i] for i in graph.roots)}")
+        exit(1)
+    return roots
+
+def needed_textures():
+    """The textures the selected planes and chapters use."""
+    needed = set()
+    sources = [] if args.skip_planes else [(None, "planes.zip")]
+    sources += [(c, f"{c}.zip") for c in chapters]
+    for c, zip_name in sources:
+        with ZipFile(str(unzbd_dir / zip_name)) as gamez:
+            with gamez.open("meshes.json") as f:
+                meshes_json = json.load(f)
+            with gamez.open("materials.json") as f:
+                materials_json = json.load(f)
+            with gamez.open("nodes.json") as f:
+                graph = NodeGraph(json.load(f))
+        if c is None:
+            mesh_indices = [m for root in selected_planes(graph) for m in atlas.mesh_indices(graph, root)]
+            substitutions = materials.PLANE_TEXTURE_SUBSTITUTIONS
+        else:
+            mesh_indices = range(len(meshes_json))
+            substitutions = materials.LEVEL_TEXTURE_SUBSTITUTIONS
+        needed |= materials.used_textures(materials_json, meshes_json, mesh_indices, substitutions)
+    return needed
+
+def run_unzbd(name, unzbd_args):
+    with instrument.timer("unzbd", item=name):
+        sub.Popen([unzbd_exe] + unzbd_args).communicate()
+
+def run_export(name, kind, target, extra_args=[]):
+    """Export a plane or a level, collecting its report if we're making one."""
+    print(f"Generating {name}.{args.format}...")
+    if args.format == "glb":
+        cmd = [sys.executable, "export_glb.py", str(unzbd_dir), str(args.blend_dir), kind, target]
+    else:
+        script = "plane2blend.py" if kind == "plane" else "world2blend.py"
+        cmd = [args.blender] + BLENDER_ARGS + [script, "--", str(unzbd_dir), str(args.blend_dir), target]
+    cmd += prune.to_args(args) + textures.to_args(args) + meshdata.to_args(args) + extra_args
+    if kind == "plane":
+        cmd += atlas.to_args(args)
+        if args.paint:
+            cmd += ["--paint", args.paint, "--rof", str(args.data_dir / "rof_output")]
+
+    if args.report:
+        sidecar = args.data_dir / "reports" / f"{name}.json"
+        sidecar.parent.mkdir(exist_ok=True)
+        cmd += ["--report", str(sidecar)]
+    with instrument.timer("export", item=name):
+        sub.Popen(cmd).communicate()
+    if args.report and sidecar.is_file():
+        instrument.report.add_child(name, instrument.load(sidecar))
+
+def run_exports(jobs):
+    with ThreadPoolExecutor(max_workers=args.jobs) as pool:
+        list(pool.map(lambda job: run_export(*job), jobs))
+
 if not args.skip_unzbd:
     if args.unzbd:
         unzbd_exe = args.unzbd
@@ -99,46 +245,83 @@ if not args.skip_unzbd:
             unzbd_exe = next(args.data_dir.rglob("unzbd.exe"))
     print(f"Using unzbd executable located at {unzbd_exe.resolve()}")
 
-    print("Extracting planes.zbd...")
-    sub.Popen([unzbd_exe, "cs", "gamez", str(args.cs / "ZBD" / "PLANES.ZBD"), str(unzbd_dir / "planes.zip")]).communicate()
+    if not args.skip_planes:
+        print("Extracting planes.zbd...")
+        run_unzbd("planes", ["cs", "gamez", str(args.cs / "ZBD" / "PLANES.ZBD"), str(unzbd_dir / "planes.zip")])
 
-    print("Extracting gamez.zbd...")
-    for c in CHAPTERS:
+    if chapters:
+        print("Extracting gamez.zbd...")
+    for c in chapters:
         gamez_path = args.cs / "ZBD" / c / "gamez.zbd"
-        sub.Popen([unzbd_exe, "cs", "gamez", str(gamez_path), str(unzbd_dir / f"{c}.zip")]).communicate()
+        run_unzbd(c, ["cs", "gamez", str(gamez_path), str(unzbd_dir / f"{c}.zip")])
 
-    print("Extracting texture.zbd...")
-    with ZipFile(unzbd_dir / "textures.zip", "w") as agg_zip:
+    # there's no telling which texture.zbd has which texture, but if they've
+    # all been extracted before that's good enough for just a few things
+    missing = None
+    if (args.planes is not None or args.levels is not None) and (unzbd_dir / "textures.zip").is_file():
+        with instrument.timer("parse_json"):
+            needed = needed_textures()
+        with ZipFile(str(unzbd_dir / "textures.zip")) as z:
+            missing = needed - set(z.namelist())
+
+    if missing is None or missing:
+        print("Extracting texture.zbd...")
+        zip_paths = []
         for f in args.cs.rglob("texture.zbd"):
             zip_path = unzbd_dir / f"{f.parent.name}_textures.zip"
-            sub.Popen([unzbd_exe, "cs", "textures", f, str(zip_path)]).communicate()
-            with ZipFile(zip_path) as chapter_zip:
-                for texture_name in chapter_zip.namelist():
-                    if texture_name not in agg_zip.namelist():
-                        agg_zip.writestr(texture_name, chapter_zip.read(texture_name))
-    
+            run_unzbd(f"{f.parent.name}_textures", ["cs", "textures", f, str(zip_path)])
+            zip_paths.append(zip_path)
+        with instrument.timer("aggregate_textures"):
+            textures.aggregate_textures(zip_paths, unzbd_dir / "textures.zip")
+    else:
+        print(f"All {len(needed)} textures needed are already extracted")
 
-if not args.skip_planes:
-    print("Generating plane .blends...")
-    print(f"Using blender executable located at {args.blender}")
+if args.texture_tier != 1 and (stale := textures.tiers_stale(unzbd_dir, [args.texture_tier])):
+    print(f"Making 1/{args.texture_tier} size textures...")
+    with instrument.timer("texture_tiers"):
+        sub.Popen([sys.executable, "textures.py", str(unzbd_dir)] + [str(t) for t in stale]).communicate()
 
-    with ZipFile(str(unzbd_dir / "planes.zip")) as level:
-        with level.open("nodes.json") as f:
-            nodes_json = json.load(f)
+if not args.skip_planes:
+    print(f"Generating plane .{args.format}s...")
+    if args.format == "blend":
+        print(f"Using blender executable located at {args.blender}")
 
-    roots = []
-    for i, n in enumerate(nodes_json):
-        v = next(iter(n.values()))
-        if v["parent"] is None:
-            roots.append((i, v["name"]))
+    with instrument.timer("parse_json"):
+        graph = NodeGraph.from_zip(unzbd_dir / "planes.zip")
 
-    for i, name in roots:
-        print(f"Generating {name}.blend...")
-        sub.Popen([args.blender] + BLENDER_ARGS + ["plane2blend.py", "--", str(unzbd_dir), str(args.blend_dir), str(i)]).communicate()
+    run_exports([(graph.names[i], "plane", str(i)) for i in selected_planes(graph)])
 
 if not args.skip_levels:
-    print("Generating level .blends...")
+    print(f"Generating level .{args.format}s...")
+
+    jobs = []
+    for c in chapters:
+        world_args = []
+        if args.tile_size is not None:
+            world_args += ["--tile-size", str(args.tile_size)]
+        if args.batch:
+            world_args.append("--batch")
+        if args.stream is not None:
+            world_args += ["--stream", str(args.stream)]
+
+        if not args.tile_files:
+            jobs.append((c, "level", c, world_args))
+            continue
+
+        with instrument.timer("parse_json"), ZipFile(str(unzbd_dir / f"{c}.zip")) as gamez:
+            with gamez.open("meshes.json") as f:
+                meshes_json = json.load(f)
+            with gamez.open("nodes.json") as f:
+                graph = NodeGraph(json.load(f))
+
+        with instrument.timer("tiling"):
+            tiles = tiling.compute_tiles(graph, meshes_json, args.tile_size)
+        tiling.write_index(args.blend_dir / f"{c}_tiles.json", c, graph, tiles, args.tile_size, per_file=True)
+        for key in sorted(tiles):
+            jobs.append((f"{c}_{key}", "level", c, world_args + ["--tile", key]))
+
+    run_exports(jobs)
 
-    for c in CHAPTERS:
-        print(f"Generating {c}.blend...")
-        sub.Popen([args.blender] + BLENDER_ARGS + ["world2blend.py", "--", str(unzbd_dir), str(args.blend_dir), c]).communicate()
+if args.report:
+    instrument.report.save(args.report)
+    instrument.report.print_summary()
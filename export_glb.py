@@ -0,0 +1,417 @@
+"""
+Exports planes and levels straight to binary glTF (.glb), without blender.
+
+    > python export_glb.py data/unzbd_output glb_output plane 3
+    > python export_glb.py data/unzbd_output glb_output level c1
+"""
+import argparse
+import io
+import json
+import struct
+import sys
+from array import array
+from pathlib import Path
+from zipfile import ZipFile
+
+from PIL import Image
+
+import atlas
+import instrument
+import materials
+import meshdata
+import prune
+import textures
+import tiling
+from nodegraph import NodeGraph
+
+FLOAT = 5126
+UNSIGNED_INT = 5125
+ARRAY_BUFFER = 34962
+ELEMENT_ARRAY_BUFFER = 34963
+
+# these don't make sense outside the game
+IGNORED_TYPES = ["Window", "Display", "Camera", "Light"]
+
+# blender is z-up, gltf is y-up
+BLENDER_TO_GLTF = [[1, 0, 0], [0, 0, 1], [0, -1, 0]]
+
+
+def to_gltf(p):
+    return (p[0], p[2], -p[1])
+
+def gltf_matrix(matrix):
+    """Turn a blender-axes (rotation, location) pair from tiling.py into a column-major gltf matrix."""
+    rot, loc = matrix
+    c = BLENDER_TO_GLTF
+    # c @ rot @ c.T
+    crot = [[sum(c[r][k] * rot[k][j] for k in range(3)) for j in range(3)] for r in range(3)]
+    grot = [[sum(crot[r][k] * c[j][k] for k in range(3)) for j in range(3)] for r in range(3)]
+    gloc = to_gltf(loc)
+    return [
+        grot[0][0], grot[1][0], grot[2][0], 0,
+        grot[0][1], grot[1][1], grot[2][1], 0,
+        grot[0][2], grot[1][2], grot[2][2], 0,
+        gloc[0], gloc[1], gloc[2], 1,
+    ]
+
+
+class GlbBuilder:
+    def __init__(self):
+        self.gltf = {
+            "asset": {"version": "2.0", "generator": "crimsonskies2blend"},
+            "scene": 0,
+            "scenes": [{"nodes": []}],
+            "nodes": [],
+            "meshes": [],
+            "materials": [],
+            "textures": [],
+            "images": [],
+            "samplers": [{}],
+            "accessors": [],
+            "bufferViews": [],
+        }
+        self.bin = bytearray()
+
+    def add_buffer_view(self, data, target=None):
+        # everything in the buffer has to be 4-byte aligned
+        self.bin.extend(bytes(-len(self.bin) % 4))
+        view = {"buffer": 0, "byteOffset": len(self.bin), "byteLength": len(data)}
+        if target is not None:
+            view["target"] = target
+        self.bin.extend(data)
+        self.gltf["bufferViews"].append(view)
+        return len(self.gltf["bufferViews"]) - 1
+
+    def add_accessor(self, values, component_type, accessor_type, width, target, min_max=False):
+        if sys.byteorder != "little":
+            values = array(values.typecode, values)
+            values.byteswap()
+        accessor = {
+            "bufferView": self.add_buffer_view(values.tobytes(), target),
+            "componentType": component_type,
+            "count": len(values) // width,
+            "type": accessor_type,
+        }
+        if min_max:
+            accessor["min"] = [min(values[a::width]) for a in range(width)]
+            accessor["max"] = [max(values[a::width]) for a in range(width)]
+        self.gltf["accessors"].append(accessor)
+        return len(self.gltf["accessors"]) - 1
+
+    def add(self, kind, item):
+        self.gltf[kind].append(item)
+        return len(self.gltf[kind]) - 1
+
+    def save(self, path):
+        # leave out empty lists, gltf doesn't allow them
+        gltf = {k: v for k, v in self.gltf.items() if v != []}
+        if self.bin:
+            gltf["buffers"] = [{"byteLength": len(self.bin)}]
+        json_chunk = json.dumps(gltf, separators=(",", ":")).encode()
+        json_chunk += b" " * (-len(json_chunk) % 4)
+        bin_chunk = bytes(self.bin) + bytes(-len(self.bin) % 4)
+
+        length = 12 + 8 + len(json_chunk) + (8 + len(bin_chunk) if bin_chunk else 0)
+        with open(path, "wb") as f:
+            f.write(struct.pack("<4sII", b"glTF", 2, length))
+            f.write(struct.pack("<I4s", len(json_chunk), b"JSON"))
+            f.write(json_chunk)
+            if bin_chunk:
+                f.write(struct.pack("<I4s", len(bin_chunk), b"BIN\x00"))
+                f.write(bin_chunk)
+
+
+class GlbExporter:
+    def __init__(self, meshes_json, materials_json, textures_zip, substitutions, texture_folder=None, atlases=None, weld=None):
+        self.meshes_json = meshes_json
+        self.materials_json = materials_json
+        self.textures_zip = textures_zip
+        self.substitutions = substitutions
+        # referenced textures get written here, otherwise they're embedded
+        self.texture_folder = texture_folder
+        self.atlases = atlases
+        self.weld = weld
+        self.builder = GlbBuilder()
+        self.meshes = {}
+        self.materials = {}
+        self.images = {}
+
+    def _get_image(self, texture_name):
+        if texture_name in self.images:
+            return self.images[texture_name]
+        try:
+            with instrument.timer("load_texture", item=texture_name):
+                data = self.textures_zip.read(texture_name)
+        except KeyError:
+            print("WARNING: did not find", texture_name)
+            self.images[texture_name] = None
+            return None
+
+        with Image.open(io.BytesIO(data)) as im:
+            alpha = im.mode == "RGBA" and im.getextrema()[3][0] < 255
+
+        self.images[texture_name] = (self._add_image(texture_name, data), alpha)
+        return self.images[texture_name]
+
+    def _add_image(self, texture_name, data):
+        if self.texture_folder is None:
+            image = {"name": texture_name, "mimeType": "image/png", "bufferView": self.builder.add_buffer_view(data)}
+        else:
+            self.texture_folder.mkdir(exist_ok=True)
+            (self.texture_folder / texture_name).write_bytes(data)
+            image = {"name": texture_name, "uri": f"{self.texture_folder.name}/{texture_name}"}
+        instrument.count("textures_loaded")
+
+        return self.builder.add("textures", {"sampler": 0, "source": self.builder.add("images", image)})
+
+    def _create_atlas_material(self, n):
+        a = self.atlases.atlases[n]
+        material = {
+            "name": a["name"],
+            "doubleSided": True,
+            "pbrMetallicRoughness": {
+                "metallicFactor": 0,
+                "roughnessFactor": 0.9,
+                "baseColorTexture": {"index": self._add_image(a["name"], self.atlases.png_bytes(n))},
+            },
+        }
+        if a["alpha"]:
+            material["alphaMode"] = "BLEND"
+        instrument.count("materials_created")
+        return self.builder.add("materials", material)
+
+    def _create_material(self, mat_index):
+        name = materials.material_name(self.materials_json, mat_index, self.substitutions)
+        m = self.materials_json[mat_index]
+        material = {
+            "name": name,
+            "doubleSided": True,
+            "pbrMetallicRoughness": {"metallicFactor": 0, "roughnessFactor": 0.9},
+        }
+        pbr = material["pbrMetallicRoughness"]
+
+        if "Colored" in m:
+            color = m["Colored"]["color"]
+            pbr["baseColorFactor"] = [color["r"] / 255, color["g"] / 255, color["b"] / 255, 1]
+        elif (image := self._get_image(name)) is None:
+            pbr["baseColorFactor"] = [1, 0, 0.5, 1]
+        else:
+            texture, alpha = image
+            pbr["baseColorTexture"] = {"index": texture}
+            if alpha:
+                material["alphaMode"] = "BLEND"
+
+        instrument.count("materials_created")
+        return self.builder.add("materials", material)
+
+    def material(self, mat_index):
+        if self.atlases is not None and (n := self.atlases.atlas_of(mat_index)) is not None:
+            if ("atlas", n) not in self.materials:
+                self.materials[("atlas", n)] = self._create_atlas_material(n)
+            return self.materials[("atlas", n)]
+        if mat_index not in self.materials:
+            self.materials[mat_index] = self._create_material(mat_index)
+        return self.materials[mat_index]
+
+    def _create_mesh(self, mesh_index):
+        m = self.meshes_json[mesh_index]
+        if not m or not m["polygons"]: return None # don't bother with those lights-only meshes
+        if self.atlases is not None:
+            m = {**m, "polygons": [self.atlases.remap_poly(poly) for poly in m["polygons"]]}
+
+        arrays = meshdata.mesh_to_arrays(m, self.weld)
+        instrument.count("faces_dropped", arrays["faces_dropped"])
+        if self.weld is not None:
+            instrument.count("vertices_welded", arrays["vertices_welded"], item=f"mesh{mesh_index:04}")
+        # blender shades these smooth, so do the same rather than leave it to the viewer. no COLOR_0
+        # though, gltf would multiply it into the base color but the .blend materials ignore vertex colors
+        normals = meshdata.loop_normals(arrays)
+
+        # gltf wants one set of attributes per vertex, so each distinct corner becomes a vertex
+        primitives = {}
+        loop = 0
+        for face_size, mat_index in zip(arrays["face_sizes"], arrays["face_materials"]):
+            # one primitive per gltf material, since atlased materials share one
+            p = primitives.setdefault(self.material(mat_index), {
+                "corners": {},
+                "positions": array("f"),
+                "uvs": array("f"),
+                "normals": array("f"),
+                "indices": array("I"),
+            })
+            corners = []
+            for l in range(loop, loop + face_size):
+                v = arrays["loop_vertices"][l]
+                uv = tuple(arrays["loop_uvs"][2 * l : 2 * l + 2])
+                normal = tuple(normals[3 * l : 3 * l + 3])
+                key = (v, uv, normal)
+                if key not in p["corners"]:
+                    p["corners"][key] = len(p["corners"])
+                    p["positions"].extend(to_gltf(arrays["positions"][3 * v : 3 * v + 3]))
+                    # blender's uvs are flipped compared to gltf's
+                    p["uvs"].extend((uv[0], 1 - uv[1]))
+                    p["normals"].extend(to_gltf(normal))
+                corners.append(p["corners"][key])
+            # faces are convex, so a fan is fine
+            for k in range(1, face_size - 1):
+                p["indices"].extend((corners[0], corners[k], corners[k + 1]))
+            loop += face_size
+
+        if not primitives: return None
+
+        mesh = {"name": f"mesh{mesh_index:04}", "primitives": []}
+        for material, p in primitives.items():
+            mesh["primitives"].append({
+                "attributes": {
+                    "POSITION": self.builder.add_accessor(p["positions"], FLOAT, "VEC3", 3, ARRAY_BUFFER, min_max=True),
+                    "TEXCOORD_0": self.builder.add_accessor(p["uvs"], FLOAT, "VEC2", 2, ARRAY_BUFFER),
+                    "NORMAL": self.builder.add_accessor(p["normals"], FLOAT, "VEC3", 3, ARRAY_BUFFER),
+                },
+                "indices": self.builder.add_accessor(p["indices"], UNSIGNED_INT, "SCALAR", 1, ELEMENT_ARRAY_BUFFER),
+                "material": material,
+            })
+        instrument.count("meshes_built")
+        return self.builder.add("meshes", mesh)
+
+    def mesh(self, mesh_index):
+        if mesh_index == -1: return None
+        if mesh_index not in self.meshes:
+            with instrument.timer("build_mesh", item=f"mesh{mesh_index:04}"):
+                self.meshes[mesh_index] = self._create_mesh(mesh_index)
+        return self.meshes[mesh_index]
+
+    def add_tree(self, graph, root, skip, name, matrix, parent=None, emptied=()):
+        """Add the nodes under root, returning the index of root's gltf node."""
+        nodes = {}
+        for i, walk_parent in graph.walk(root, skip):
+            v = graph.nodes[i]
+            node = {"name": name(i)}
+            if m := matrix(i):
+                node["matrix"] = m
+            if "mesh_index" in v and i not in emptied and (mesh := self.mesh(v["mesh_index"])) is not None:
+                node["mesh"] = mesh
+            nodes[i] = self.builder.add("nodes", node)
+
+            parent_node = nodes[walk_parent] if walk_parent is not None else parent
+            if parent_node is None:
+                self.builder.gltf["scenes"][0]["nodes"].append(nodes[i])
+            else:
+                self.builder.gltf["nodes"][parent_node].setdefault("children", []).append(nodes[i])
+        return nodes.get(root)
+
+    def save(self, path):
+        with instrument.timer("save"):
+            self.builder.save(path)
+
+
+def local_gltf_matrix(graph, i, scale=1):
+    v = graph.nodes[i]
+    if not v.get("transformation") and graph.types[i] != "World" and scale == 1:
+        return None
+    rot, loc = tiling.local_matrix(graph.types[i], v)
+    return gltf_matrix(([[c * scale for c in row] for row in rot], loc))
+
+def export_plane(exporter, graph, root, skipped, emptied):
+    def matrix(i):
+        # normalize cockpit scale
+        return local_gltf_matrix(graph, i, 0.03 if graph.names[i] == "cockpit1" else 1)
+
+    exporter.add_tree(
+        graph, root,
+        skip=lambda c: c in skipped,
+        name=lambda i: graph.names[i],
+        matrix=matrix,
+        emptied=emptied)
+
+def export_level(exporter, graph, skipped, emptied):
+    def skip(i):
+        return i in skipped or graph.types[i] in IGNORED_TYPES
+
+    def name(i):
+        return "world" if graph.types[i] == "World" else graph.unique_names[i]
+
+    def matrix(i):
+        return local_gltf_matrix(graph, i)
+
+    root_nodes = {}
+    for root in graph.roots:
+        root_nodes[root] = exporter.add_tree(graph, root, skip, name, matrix, emptied=emptied)
+
+    # the world node doesn't actually have its terrain in children *eyeroll*
+    for i in graph.detached_children(0):
+        exporter.add_tree(graph, i, skip, name, matrix, parent=root_nodes.get(0), emptied=emptied)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export a plane or level straight to .glb, without blender.")
+    parser.add_argument("data_folder", type=Path, help="unzbd output folder")
+    parser.add_argument("out_folder", type=Path)
+    parser.add_argument("kind", choices=["plane", "level"])
+    parser.add_argument("target", help="Root node index for planes, chapter name for levels")
+    parser.add_argument(
+        "--textures",
+        choices=["embed", "reference"],
+        default="embed",
+        help="Embed textures in the .glb, or write them next to it. Defaults to embed")
+    prune.add_arguments(parser)
+    textures.add_arguments(parser)
+    meshdata.add_arguments(parser)
+    atlas.add_arguments(parser)
+    parser.add_argument(
+        "--report",
+        metavar="FILE",
+        type=Path,
+        help="Save timings and counters to this json file")
+    args = parser.parse_args()
+
+    zip_name = "planes.zip" if args.kind == "plane" else f"{args.target}.zip"
+    with instrument.timer("parse_json"), ZipFile(str(args.data_folder / zip_name)) as gamez:
+        with gamez.open("meshes.json") as f:
+            meshes_json = json.load(f)
+        with gamez.open("materials.json") as f:
+            materials_json = json.load(f)
+        with gamez.open("nodes.json") as f:
+            graph = NodeGraph(json.load(f))
+
+    policy = prune.PrunePolicy.from_args(args)
+    if args.kind == "plane":
+        # gltf has no way to hide a node, so leave out what the .blend would hide, unless told otherwise
+        if args.lod is None:
+            policy.lod = "nearest"
+        if not args.drop:
+            policy.drop = set(prune.HIDDEN + prune.PARTIAL)
+    skipped, emptied = policy.apply(graph)
+
+    args.out_folder.mkdir(exist_ok=True)
+    texture_folder = args.out_folder / "textures" if args.textures == "reference" else None
+    substitutions = materials.PLANE_TEXTURE_SUBSTITUTIONS if args.kind == "plane" else materials.LEVEL_TEXTURE_SUBSTITUTIONS
+
+    if args.atlas and args.kind != "plane":
+        print("ERROR: --atlas only works for planes")
+        exit(1)
+
+    textures.check_tier(args.data_folder, args.texture_tier)
+
+    with ZipFile(str(textures.tier_path(args.data_folder, args.texture_tier))) as textures_zip:
+        atlases = None
+        if args.atlas:
+            root = int(args.target)
+            with instrument.timer("atlas"):
+                mesh_indices = atlas.mesh_indices(graph, root, skipped, emptied)
+                atlases = atlas.AtlasSet.build(
+                    textures_zip, materials_json, meshes_json, mesh_indices, substitutions,
+                    max_size=args.atlas_size, name=f"{graph.names[root]}_atlas")
+
+        exporter = GlbExporter(meshes_json, materials_json, textures_zip, substitutions, texture_folder, atlases, args.weld)
+        with instrument.timer("build"):
+            if args.kind == "plane":
+                root = int(args.target)
+                export_plane(exporter, graph, root, skipped, emptied)
+                out_name = graph.names[root]
+            else:
+                export_level(exporter, graph, skipped, emptied)
+                out_name = args.target
+        exporter.save(args.out_folder / f"{out_name}.glb")
+
+    if args.report:
+        instrument.report.save(args.report)
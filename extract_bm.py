@@ -7,7 +7,7 @@ def save_image(fmt, size, bytes, filename):
     im = Image.frombytes(fmt, size, bytes)
     im.transpose(method=Image.Transpose.FLIP_TOP_BOTTOM).save(filename)
 
-for path in Path().rglob("*.bm"):
+def convert_bm(path):
     with open(path, "rb") as bm:
         (height, width) = struct.unpack("<HH", bm.read(4))
         num_pixels = width * height
@@ -18,3 +18,7 @@ for path in Path().rglob("*.bm"):
         save_image("L", size, bm.read(num_pixels), path.parent / (path.stem + "-color2.png"))
         save_image("L", size, bm.read(num_pixels), path.parent / (path.stem + "-color3.png"))
         save_image("RGBA", size, bm.read(num_pixels*4), path.parent / (path.stem + "-specular.png"))
+
+if __name__ == "__main__":
+    for path in Path().rglob("*.bm"):
+        convert_bm(path)
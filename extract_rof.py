@@ -60,9 +60,10 @@ def write_tree_to_disk(entry, cwd, f):
             f.seek(entry["start"])
             new_file.write(f.read(entry["length"]))
 
-with open(ROF_PATH, mode='rb') as f:
-    root = {"start": 0, "name": "rof_output", "is_dir": True}
-    parse_entry(root, f)
-    out_path = Path(root["name"])
-    if out_path.is_dir(): shutil.rmtree(out_path)
-    write_tree_to_disk(root, Path("data"), f)
+if __name__ == "__main__":
+    with open(ROF_PATH, mode='rb') as f:
+        root = {"start": 0, "name": "rof_output", "is_dir": True}
+        parse_entry(root, f)
+        out_path = Path(root["name"])
+        if out_path.is_dir(): shutil.rmtree(out_path)
+        write_tree_to_disk(root, Path("data"), f)
@@ -0,0 +1,169 @@
+"""
+Nested timers and counters for finding out where an export spends its time.
+
+The blender scripts save theirs to a sidecar json with --report, and
+everything2blend.py merges them all into one run report.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Report:
+    def __init__(self):
+        self.timers = {}
+        self.counters = {}
+        # per-item times for the slowest-n view, e.g. each mesh
+        self.items = {}
+        # per-item counts, e.g. vertices welded in each mesh
+        self.item_counts = {}
+        self.children = {}
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def _stack(self):
+        if not hasattr(self._local, "stack"):
+            self._local.stack = []
+        return self._local.stack
+
+    @contextmanager
+    def timer(self, name, item=None):
+        """Time a block. Timers inside other timers are recorded as parent/child."""
+        stack = self._stack()
+        stack.append(name)
+        path = "/".join(stack)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            stack.pop()
+            with self._lock:
+                timer = self.timers.setdefault(path, {"seconds": 0, "calls": 0})
+                timer["seconds"] += seconds
+                timer["calls"] += 1
+                if item is not None:
+                    items = self.items.setdefault(name, {})
+                    items[item] = items.get(item, 0) + seconds
+
+    def count(self, name, n=1, item=None):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + n
+            if item is not None:
+                items = self.item_counts.setdefault(name, {})
+                items[item] = items.get(item, 0) + n
+
+    def add_child(self, name, child):
+        """Fold in the report of a job, e.g. one blender run."""
+        with self._lock:
+            self.children[name] = child
+            for counter, n in child.get("counters", {}).items():
+                self.counters[counter] = self.counters.get(counter, 0) + n
+            for item_name, items in child.get("items", {}).items():
+                merged = self.items.setdefault(item_name, {})
+                for item, seconds in items.items():
+                    merged[f"{name}:{item}"] = seconds
+            for item_name, items in child.get("item_counts", {}).items():
+                merged = self.item_counts.setdefault(item_name, {})
+                for item, n in items.items():
+                    merged[f"{name}:{item}"] = n
+
+    def slowest(self, name, n=10):
+        return sorted(self.items.get(name, {}).items(), key=lambda item: item[1], reverse=True)[:n]
+
+    def most(self, name, n=10):
+        return sorted(self.item_counts.get(name, {}).items(), key=lambda item: item[1], reverse=True)[:n]
+
+    def to_json(self, top=10):
+        return {
+            "timers": self.timers,
+            "counters": self.counters,
+            "items": self.items,
+            "item_counts": self.item_counts,
+            "slowest": {name: self.slowest(name, top) for name in self.items},
+            "most": {name: self.most(name, top) for name in self.item_counts},
+            "jobs": self.children,
+        }
+
+    def save(self, path, top=10):
+        with open(path, "w") as f:
+            json.dump(self.to_json(top), f, indent=2)
+
+    def print_summary(self, top=10):
+        for path, timer in self.timers.items():
+            print(f"{path:<40}{timer['seconds']:>10.2f}s{timer['calls']:>8}x")
+        for name, n in sorted(self.counters.items()):
+            print(f"{name:<40}{n:>10}")
+        for name in self.items:
+            print(f"Slowest {name}:")
+            for item, seconds in self.slowest(name, top):
+                print(f"    {item:<36}{seconds:>10.2f}s")
+        for name in self.item_counts:
+            print(f"Most {name}:")
+            for item, n in self.most(name, top):
+                print(f"    {item:<36}{n:>10}")
+
+
+# one report per process, which is all the scripts need
+report = Report()
+timer = report.timer
+count = report.count
+
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def memory_usage(peak=False):
+    """
+    How much memory this process is using right now in bytes, or the most it's
+    used so far with peak, or None if we can't tell. Unlike tracemalloc this
+    counts what C code like pillow allocates too.
+    """
+    if sys.platform == "win32":
+        import ctypes
+        from ctypes import wintypes
+
+        class PROCESS_MEMORY_COUNTERS(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD), ("PageFaultCount", wintypes.DWORD)] + [
+                (name, ctypes.c_size_t) for name in [
+                    "PeakWorkingSetSize", "WorkingSetSize",
+                    "QuotaPeakPagedPoolUsage", "QuotaPagedPoolUsage",
+                    "QuotaPeakNonPagedPoolUsage", "QuotaNonPagedPoolUsage",
+                    "PagefileUsage", "PeakPagefileUsage",
+                ]
+            ]
+
+        counters = PROCESS_MEMORY_COUNTERS()
+        counters.cb = ctypes.sizeof(counters)
+        kernel32 = ctypes.windll.kernel32
+        psapi = ctypes.windll.psapi
+        kernel32.GetCurrentProcess.restype = wintypes.HANDLE
+        psapi.GetProcessMemoryInfo.argtypes = [wintypes.HANDLE, ctypes.POINTER(PROCESS_MEMORY_COUNTERS), wintypes.DWORD]
+        if psapi.GetProcessMemoryInfo(kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize if peak else counters.WorkingSetSize
+        return None
+
+    if peak:
+        # not ru_maxrss on linux, that carries over from whatever process started this one
+        try:
+            with open("/proc/self/status") as f:
+                for line in f:
+                    if line.startswith("VmHWM:"):
+                        return int(line.split()[1]) * 1024
+        except (OSError, ValueError):
+            pass
+        if sys.platform == "darwin":
+            import resource
+            # in bytes on macos
+            return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return None
+
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
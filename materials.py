@@ -0,0 +1,74 @@
+"""
+Material and texture naming shared by the exporters.
+"""
+import os.path
+
+PLANE_TEXTURE_SUBSTITUTIONS = {
+    # higher res textures
+    "agyro_taillogo.png": "12its_logo1.png",
+    "agyro_winglogo.png": "12its_logo1.png",
+    "bal_taillogo.png": "british_tail.png",
+    "bal_winglogo.png": "04british_logo1.png",
+    "blo_taillogo.png": "blake_logo1.png",
+    "blo_winglogo.png": "blake_logo1.png",
+    "bri_taillogo.png": "14medusa_logo1.png",
+    "bri_winglogo.png": "14medusa_logo1.png",
+    "dev_taillogo.png": "fhunter_logo2.png",
+    "dev_winglogo.png": "07fhunter_logo1.png",
+    "fir_taillogo.png": "10hknights_logo2.png",
+    "fir_winglogo.png": "hollywoodlogo.png",
+    "fur_taillogo.png": "bswan_logo1.png",
+    "fur_winglogo.png": "bswan_logo1.png",
+    "hel_taillogo.png": "sacredtrust_logo1.png",
+    "hel_winglogo.png": "sacredtrust_logo1.png",
+    "kes_taillogo.png": "14medusa_logo1.png",
+    "kes_winglogo.png": "14medusa_logo1.png",
+    "pea_taillogo.png": "blake_logo1.png",
+    "pea_winglogo.png": "blake_logo1.png",
+    "war_taillogo.png": "blackhat_logo1.png",
+    "war_winglogo.png": "blackhat_logo1.png",
+    # these are different textures, but match what's in-game
+    "bal_noselogo.png": "21ace_star.png",
+    "blo_noselogo.png": "21ace_star.png",
+    "bri_noselogo.png": "21ace_star.png",
+    "dev_noselogo.png": "40ohsoblue.png",
+    "fur_noselogo.png": "21ace_star.png",
+    "hel_noselogo.png": "21ace_star.png",
+    "kes_noselogo.png": "21ace_star.png",
+    "pea_noselogo.png": "21ace_star.png",
+    "war_noselogo.png": "21ace_star.png",
+}
+
+# the levels use a different winglogo for the devastator
+LEVEL_TEXTURE_SUBSTITUTIONS = {
+    **PLANE_TEXTURE_SUBSTITUTIONS,
+    "dev_winglogo.png": "fhunter_logo4_1.png",
+}
+
+
+def material_name(materials_json, i, substitutions):
+    """The name of material i, which for textured materials is the name of its png in textures.zip."""
+    m = materials_json[i]
+    if "Colored" in m: return f"material_{i}"
+    
+    tif_name = m["Textured"]["texture"]
+
+    # some textures have spurious segments like bldhwk_cowling.5.tif which can be ignored
+    if len(parts := tif_name.split(".")) > 2:
+        tif_name = parts[0] + "." + parts[-1]
+
+    png_name = os.path.splitext(tif_name.lower())[0] + ".png"
+
+    # get a better texture if we have one
+    return substitutions.get(png_name, png_name)
+
+def used_textures(materials_json, meshes_json, mesh_indices, substitutions):
+    """The names of the textures the given meshes need."""
+    res = set()
+    for mesh_index in mesh_indices:
+        if not (m := meshes_json[mesh_index]): continue
+        for poly in m["polygons"]:
+            i = poly["materials"][0]["material_index"]
+            if "Textured" in materials_json[i]:
+                res.add(material_name(materials_json, i, substitutions))
+    return res
@@ -0,0 +1,183 @@
+"""
+Turns meshes from meshes.json into flat arrays, without needing blender.
+"""
+import math
+from array import array
+
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--weld",
+        metavar="EPSILON",
+        type=float,
+        help="Merge vertices closer together than this before building meshes, e.g. 0.0001")
+
+def to_args(args):
+    """Turn parsed arguments back into a command line, for passing on to the export scripts."""
+    return ["--weld", str(args.weld)] if args.weld is not None else []
+
+def convert_vertex(v):
+    # the game is y-up, blender is z-up
+    return (v["x"], -v["z"], v["y"])
+
+def weld(positions, epsilon):
+    """
+    Merge vertices less than epsilon apart. A spatial hash of epsilon sized cells
+    means each vertex is only compared with the ones in neighbouring cells.
+    Returns the welded positions, and the new index of each old vertex.
+    """
+    welded = array("f")
+    remap = array("I")
+    cells = {}
+    for k in range(len(positions) // 3):
+        p = positions[3 * k : 3 * k + 3]
+        if epsilon <= 0:
+            # only exact duplicates
+            cell = tuple(p)
+            neighbours = [cell]
+        else:
+            cell = tuple(math.floor(c / epsilon) for c in p)
+            neighbours = [(cell[0] + dx, cell[1] + dy, cell[2] + dz) for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)]
+
+        match = None
+        for n in neighbours:
+            for j in cells.get(n, ()):
+                if sum((a - b) ** 2 for a, b in zip(p, welded[3 * j : 3 * j + 3])) <= epsilon * epsilon:
+                    match = j
+                    break
+            if match is not None: break
+
+        if match is None:
+            match = len(welded) // 3
+            welded.extend(p)
+            cells.setdefault(cell, []).append(match)
+        remap.append(match)
+    return welded, remap
+
+def mesh_positions(mesh, epsilon=None):
+    """
+    The mesh's vertex positions as a flat float32 array in blender's axes, and its
+    polygons. With an epsilon the vertices are welded first and the polygons point
+    at the welded ones. uvs and colors are per loop, so seams between faces stay.
+    """
+    positions = array("f")
+    for v in mesh["vertices"]:
+        positions.extend(convert_vertex(v))
+    if epsilon is None:
+        return positions, mesh["polygons"]
+
+    positions, remap = weld(positions, epsilon)
+    polygons = [{**poly, "vertex_indices": [remap[v] for v in poly["vertex_indices"]]} for poly in mesh["polygons"]]
+    return positions, polygons
+
+def decode_faces(poly):
+    """
+    Yields the faces making up a polygon, as (vertex indices, loop indices) pairs.
+    The loop indices point into the polygon's uv_coords and vertex_colors.
+    """
+    verts = poly["vertex_indices"]
+    if "triangle_strip" in poly["flags"]:
+        for i in range(len(verts) - 3 + 1):
+            # every other triangle in a strip is wound the other way round
+            loops = (i, i + 1, i + 2) if i % 2 == 0 else (i + 1, i, i + 2)
+            yield [verts[j] for j in loops], loops
+    else:
+        yield verts, range(len(verts))
+
+def mesh_to_arrays(mesh, epsilon=None):
+    """
+    Flatten a mesh into arrays, in blender's axes. Loops are the corners of
+    faces, each with their own uv and color. With an epsilon, vertices are
+    welded first.
+
+    Faces blender would refuse to create are left out: ones which use the same
+    vertex twice, and ones which use the same vertices as an earlier face.
+    """
+    positions, polygons = mesh_positions(mesh, epsilon)
+    res = {
+        "positions": positions,
+        "loop_vertices": array("I"),
+        "loop_uvs": array("f"),
+        "loop_colors": array("f"),
+        "face_sizes": array("I"),
+        "face_materials": array("I"),
+        "faces_dropped": 0,
+        "vertices_welded": len(mesh["vertices"]) - len(positions) // 3,
+    }
+
+    seen = set()
+    for poly in polygons:
+        colors = poly["vertex_colors"] or []
+        mat_index = poly["materials"][0]["material_index"]
+        uvs = poly["materials"][0]["uv_coords"] or []
+
+        for verts, loops in decode_faces(poly):
+            key = frozenset(verts)
+            if len(key) != len(verts) or key in seen:
+                res["faces_dropped"] += 1
+                continue
+            seen.add(key)
+
+            res["loop_vertices"].extend(verts)
+            for j in loops:
+                # colored materials don't have uvs
+                uv = uvs[j] if j < len(uvs) else {"u": 0, "v": 1}
+                res["loop_uvs"].extend((uv["u"], 1 - uv["v"]))
+                color = colors[j] if j < len(colors) else {"r": 255, "g": 255, "b": 255}
+                res["loop_colors"].extend((color["r"] / 255, color["g"] / 255, color["b"] / 255, 1))
+            res["face_sizes"].append(len(verts))
+            res["face_materials"].append(mat_index)
+
+    return res
+
+def loop_normals(arrays):
+    """
+    Smooth normals for each loop of mesh_to_arrays' output, like blender's smooth
+    shading: each vertex gets the average of the normals of the faces around it,
+    weighted by the angle of the face's corner there. Where those cancel out the
+    loop falls back to its face's normal.
+    """
+    positions = arrays["positions"]
+
+    def sub(a, b):
+        return (a[0] - b[0], a[1] - b[1], a[2] - b[2])
+
+    def normalize(n):
+        length = math.sqrt(n[0] * n[0] + n[1] * n[1] + n[2] * n[2])
+        return (n[0] / length, n[1] / length, n[2] / length) if length > 1e-12 else None
+
+    vertex_sums = {}
+    face_normals = []
+    loop = 0
+    for face_size in arrays["face_sizes"]:
+        verts = arrays["loop_vertices"][loop : loop + face_size]
+        ps = [positions[3 * v : 3 * v + 3] for v in verts]
+        # newell's method, works for any convex polygon
+        n = [0.0, 0.0, 0.0]
+        for k in range(face_size):
+            a, b = ps[k], ps[(k + 1) % face_size]
+            n[0] += (a[1] - b[1]) * (a[2] + b[2])
+            n[1] += (a[2] - b[2]) * (a[0] + b[0])
+            n[2] += (a[0] - b[0]) * (a[1] + b[1])
+        n = normalize(n) or (0.0, 0.0, 1.0)
+        face_normals.append(n)
+
+        for k, v in enumerate(verts):
+            e1 = normalize(sub(ps[(k + 1) % face_size], ps[k]))
+            e2 = normalize(sub(ps[k - 1], ps[k]))
+            if e1 is None or e2 is None: continue
+            angle = math.acos(max(-1.0, min(1.0, e1[0] * e2[0] + e1[1] * e2[1] + e1[2] * e2[2])))
+            s = vertex_sums.setdefault(v, [0.0, 0.0, 0.0])
+            s[0] += n[0] * angle
+            s[1] += n[1] * angle
+            s[2] += n[2] * angle
+        loop += face_size
+
+    vertex_normals = {v: normalize(s) for v, s in vertex_sums.items()}
+    res = array("f")
+    loop = 0
+    for face_size, n in zip(arrays["face_sizes"], face_normals):
+        for v in arrays["loop_vertices"][loop : loop + face_size]:
+            res.extend(vertex_normals.get(v) or n)
+        loop += face_size
+    return res
@@ -0,0 +1,64 @@
+"""
+Index of a nodes.json dump, built once and shared by all the scripts.
+
+Scene graphs can get deep, so nothing in here recurses.
+"""
+import json
+from zipfile import ZipFile
+
+
+class NodeGraph:
+    def __init__(self, nodes_json):
+        self.nodes = []
+        self.types = []
+        self.names = []
+        self.unique_names = []
+        self.parents = []
+        self.children = []
+        self.roots = []
+        # node type -> indices of the nodes of that type, in order
+        self.by_type = {}
+
+        for i, n in enumerate(nodes_json):
+            node_type, v = next(iter(n.items()))
+            self.nodes.append(v)
+            self.types.append(node_type)
+            self.names.append(v.get("name"))
+            # node names aren't unique!
+            self.unique_names.append(v["name"] + f"_{i:04}" if "name" in v else None)
+            self.parents.append(v.get("parent"))
+            self.children.append(v.get("children") or [])
+            self.by_type.setdefault(node_type, []).append(i)
+            if v.get("parent") is None:
+                self.roots.append(i)
+
+    @classmethod
+    def from_zip(cls, path):
+        with ZipFile(str(path)) as z:
+            with z.open("nodes.json") as f:
+                return cls(json.load(f))
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def walk(self, root, skip=lambda i: False):
+        """
+        Yields (node, parent) pairs depth-first, parents before their children.
+        Nodes for which skip is true are left out along with their subtree.
+        """
+        if skip(root): return
+        stack = [(root, None)]
+        while stack:
+            i, parent = stack.pop()
+            yield i, parent
+            # reversed so children come out in their original order
+            stack.extend((ci, i) for ci in reversed(self.children[i]) if not skip(ci))
+
+    def subtree(self, root, skip=lambda i: False):
+        for i, _ in self.walk(root, skip):
+            yield i
+
+    def detached_children(self, i):
+        """Nodes which say i is their parent, but aren't in its children."""
+        children = set(self.children[i])
+        return [j for j, parent in enumerate(self.parents) if parent == i and j not in children]
@@ -5,6 +5,7 @@ except ImportError:
     print("This scripts are supposed to be run inside blender! It's much easier to just run everything2blend.py, which will handle that tricky stuff for you.")
     exit(1)
 
+import argparse
 import json
 import os.path
 import sys
@@ -13,49 +14,26 @@ from pathlib import Path
 from tempfile import TemporaryDirectory
 from zipfile import ZipFile
 
-from PIL import Image
-
-TEXTURE_SUBSTITUTIONS = {
-    # higher res textures
-    "agyro_taillogo.png": "12its_logo1.png",
-    "agyro_winglogo.png": "12its_logo1.png",
-    "bal_taillogo.png": "british_tail.png",
-    "bal_winglogo.png": "04british_logo1.png",
-    "blo_taillogo.png": "blake_logo1.png",
-    "blo_winglogo.png": "blake_logo1.png",
-    "bri_taillogo.png": "14medusa_logo1.png",
-    "bri_winglogo.png": "14medusa_logo1.png",
-    "dev_taillogo.png": "fhunter_logo2.png",
-    "dev_winglogo.png": "07fhunter_logo1.png",
-    "fir_taillogo.png": "10hknights_logo2.png",
-    "fir_winglogo.png": "hollywoodlogo.png",
-    "fur_taillogo.png": "bswan_logo1.png",
-    "fur_winglogo.png": "bswan_logo1.png",
-    "hel_taillogo.png": "sacredtrust_logo1.png",
-    "hel_winglogo.png": "sacredtrust_logo1.png",
-    "kes_taillogo.png": "14medusa_logo1.png",
-    "kes_winglogo.png": "14medusa_logo1.png",
-    "pea_taillogo.png": "blake_logo1.png",
-    "pea_winglogo.png": "blake_logo1.png",
-    "war_taillogo.png": "blackhat_logo1.png",
-    "war_winglogo.png": "blackhat_logo1.png",
-    # these are different textures, but match what's in-game
-    "bal_noselogo.png": "21ace_star.png",
-    "blo_noselogo.png": "21ace_star.png",
-    "bri_noselogo.png": "21ace_star.png",
-    "dev_noselogo.png": "40ohsoblue.png",
-    "fur_noselogo.png": "21ace_star.png",
-    "hel_noselogo.png": "21ace_star.png",
-    "kes_noselogo.png": "21ace_star.png",
-    "pea_noselogo.png": "21ace_star.png",
-    "war_noselogo.png": "21ace_star.png",
-}
+from PIL import ImageColor
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import atlas
+import instrument
+import materials
+import meshdata
+import prune
+import set_paintjob
+import textures
+from nodegraph import NodeGraph
+
+TEXTURE_SUBSTITUTIONS = materials.PLANE_TEXTURE_SUBSTITUTIONS
 
 
 class MeshFactory:
-    def __init__(self, meshes_json, material_factory):
+    def __init__(self, meshes_json, material_factory, weld=None):
         self.meshes_json = meshes_json
         self.material_factory = material_factory
+        self.weld = weld
 
     @staticmethod
     def _get_name(mesh_index):
@@ -70,21 +48,29 @@ class MeshFactory:
         mesh_data = bpy.data.meshes.new(name=self._get_name(mesh_index))
         mat_indices = set([p["materials"][0]["material_index"] for p in m["polygons"]])
         local_mat_indices = {}
-        for local_mat_index, mat_index in enumerate(mat_indices):
+        for mat_index in mat_indices:
             mat = material_factory(mat_index)
-            local_mat_indices[mat_index] = local_mat_index
-            mesh_data.materials.append(mat)
+            # atlased materials share one material
+            if mat.name not in mesh_data.materials:
+                mesh_data.materials.append(mat)
+            local_mat_indices[mat_index] = mesh_data.materials.find(mat.name)
 
         bm = bmesh.new(use_operators=True)
         uv_layer = bm.loops.layers.uv.new()
         color_layer = bm.loops.layers.color.new("color")
 
-        for v in m["vertices"]:
-            bm.verts.new((v["x"], -v["z"], v["y"]))
+        positions, polygons = meshdata.mesh_positions(m, self.weld)
+        if self.weld is not None:
+            instrument.count("vertices_welded", len(m["vertices"]) - len(positions) // 3, item=self._get_name(mesh_index))
+        for k in range(0, len(positions), 3):
+            bm.verts.new(positions[k : k + 3])
         bm.verts.ensure_lookup_table()
         bm.verts.index_update()
 
-        for poly in m["polygons"]:
+        instrument.count("meshes_built")
+        for poly in polygons:
+            if material_factory.atlases is not None:
+                poly = material_factory.atlases.remap_poly(poly)
             self._process_poly(bm, poly, uv_layer, color_layer, local_mat_indices)
 
         assert(len(bm.faces))
@@ -108,6 +94,7 @@ class MeshFactory:
                 window = verts[i : i + 3]
                 if len(set(window)) != len(window):
                     # ignore tris with duplicate verts
+                    instrument.count("faces_degenerate")
                     continue
                 try:
                     face = bm.faces.new(bm.verts[i] for i in window)
@@ -116,6 +103,7 @@ class MeshFactory:
                 except ValueError:
                     # print("WARNING: couldn't create face in triangle strip for some unknown reason")
                     # yeah this happens a lot but the meshes look good so whatever
+                    instrument.count("faces_dropped")
                     continue
 
                 colors_window = colors[i : i + 3]
@@ -133,6 +121,7 @@ class MeshFactory:
                 face.material_index = local_mat_indices[mat_index]
             except ValueError:
                 # print("WARNING: couldn't create face in N-gon for some unknown reason")
+                instrument.count("faces_dropped")
                 return
 
             for index_in_mesh, loop, color in zip(verts, face.loops, colors):
@@ -142,11 +131,13 @@ class MeshFactory:
                 loop[uv_layer].uv = (uv["u"], 1 - uv["v"])
     
     def __call__(self, mesh_index):
+        if mesh_index == -1: return None
         name = self._get_name(mesh_index)
         if name in bpy.data.meshes:
             return bpy.data.meshes[name]
         else:
-            return self._create_mesh(mesh_index)
+            with instrument.timer("build_mesh", item=name):
+                return self._create_mesh(mesh_index)
 
 
 class MaterialFactory:
@@ -156,54 +147,54 @@ class MaterialFactory:
         cls,
         textures,
         materials_json,
+        atlases=None,
+        paintjob=None,
+        prefetch=(),
     ):
         with TemporaryDirectory() as tempdir:
-            yield cls(textures, materials_json, Path(tempdir))
+            factory = cls(textures, materials_json, Path(tempdir), atlases, paintjob, prefetch)
+            try:
+                yield factory
+            finally:
+                factory.prefetcher.close()
 
     def __init__(
         self,
         textures_zip,
         materials_json,
         tempdir,
+        atlases=None,
+        paintjob=None,
+        prefetch=(),
     ):
         self.tempdir = Path(tempdir)
-        self.textures_zip = ZipFile(textures_zip)
+        # textures get extracted in the background while meshes are built
+        self.prefetcher = textures.Prefetcher(textures_zip, self.tempdir, prefetch)
         self.materials_json = materials_json
-
-    @staticmethod
-    def has_alpha(fname):
-        if os.path.isfile(fname):
-            with Image.open(fname) as im:
-                return im.mode == "RGBA" and im.getextrema()[3][0] < 255
+        self.atlases = atlases
+        self.paintjob = paintjob
     
     def _get_image(self, texture_name):
         if texture_name in bpy.data.images:
             return bpy.data.images[texture_name]
-        try:
-            self.textures_zip.extract(texture_name, path=str(self.tempdir))
-            return bpy.data.images.load(str(self.tempdir / texture_name))
-        except KeyError:
-            print("WARNING: did not find", texture_name)
+        with instrument.timer("load_texture", item=texture_name):
+            if (fetched := self.prefetcher.get(texture_name)) is None:
+                print("WARNING: did not find", texture_name)
+                return None
+            image = bpy.data.images.load(str(fetched[0]))
+        instrument.count("textures_loaded")
+        # these all get packed into the .blend when it's saved
+        instrument.count("bytes_packed", os.path.getsize(fetched[0]))
+        return image
         
     def _get_name(self, i):
-        m = self.materials_json[i]
-        if "Colored" in m: return f"material_{i}"
-        
-        tif_name = m["Textured"]["texture"]
-
-        # some textures have spurious segments like bldhwk_cowling.5.tif which can be ignored
-        if len(parts := tif_name.split(".")) > 2:
-            tif_name = parts[0] + "." + parts[-1]
-
-        png_name = os.path.splitext(tif_name.lower())[0] + ".png"
-
-        # get a better texture if we have one
-        return TEXTURE_SUBSTITUTIONS.get(png_name, png_name)
+        return materials.material_name(self.materials_json, i, TEXTURE_SUBSTITUTIONS)
 
     def _create_material(self, mat_index):
         name = self._get_name(mat_index)
         m = materials_json[mat_index]
         material = bpy.data.materials.new(name)
+        instrument.count("materials_created")
         material.use_nodes = True
         bsdf = material.node_tree.nodes["Principled BSDF"]
 
@@ -211,6 +202,9 @@ class MaterialFactory:
             # create a simple colored material
             color = m["Colored"]["color"]
             bsdf.inputs["Base Color"].default_value = (color["r"] / 255, color["g"] / 255, color["b"] / 255, 1)
+        elif self.paintjob is not None and name in self.paintjob.layers:
+            # tint the .bm layers in nodes instead of using the baked texture
+            self.paintjob.link(material, name)
         else:
             # create a textured material
             image = self._get_image(name)
@@ -218,21 +212,46 @@ class MaterialFactory:
                 bsdf.inputs["Base Color"].default_value = (1, 0, 0.5, 1)
                 return material
         
-            tex = material.node_tree.nodes.new("ShaderNodeTexImage")
-            tex.image = image
-            material.node_tree.links.new(bsdf.inputs["Base Color"], tex.outputs["Color"])
+            self._link_texture(material, image, self.prefetcher.get(name)[1])
 
-            if self.has_alpha(str(self.tempdir / name)):
-                material.node_tree.links.new(bsdf.inputs["Alpha"], tex.outputs["Alpha"])
-                material.blend_method = "BLEND"
-                material.shadow_method = "CLIP"
-                material.alpha_threshold = 0.8
+        material.roughness = 0.9
+        material.specular_intensity = 0.1
+        return material
 
+    @staticmethod
+    def _link_texture(material, image, alpha):
+        bsdf = material.node_tree.nodes["Principled BSDF"]
+        tex = material.node_tree.nodes.new("ShaderNodeTexImage")
+        tex.image = image
+        material.node_tree.links.new(bsdf.inputs["Base Color"], tex.outputs["Color"])
+
+        if alpha:
+            material.node_tree.links.new(bsdf.inputs["Alpha"], tex.outputs["Alpha"])
+            material.blend_method = "BLEND"
+            material.shadow_method = "CLIP"
+            material.alpha_threshold = 0.8
+
+    def _get_atlas_material(self, n):
+        a = self.atlases.atlases[n]
+        if a["name"] in bpy.data.materials:
+            return bpy.data.materials[a["name"]]
+
+        a["image"].save(self.tempdir / a["name"])
+        image = bpy.data.images.load(str(self.tempdir / a["name"]))
+        instrument.count("textures_loaded")
+        instrument.count("bytes_packed", os.path.getsize(self.tempdir / a["name"]))
+
+        material = bpy.data.materials.new(a["name"])
+        instrument.count("materials_created")
+        material.use_nodes = True
+        self._link_texture(material, image, a["alpha"])
         material.roughness = 0.9
         material.specular_intensity = 0.1
         return material
 
     def __call__(self, mat_index):
+        if self.atlases is not None and (n := self.atlases.atlas_of(mat_index)) is not None:
+            return self._get_atlas_material(n)
         name = self._get_name(mat_index)
         if name in bpy.data.materials:
             return bpy.data.materials[name]
@@ -240,17 +259,126 @@ class MaterialFactory:
             return self._create_material(mat_index)
         
 
-def hide_recursive(obj, except_condition = lambda c: False):
-    obj.hide_set(True)
-    for c in obj.children:
-        if not except_condition(c):
-            hide_recursive(c, except_condition)
-
-def create_object_tree(i, mesh_factory, col):
-    n = nodes_json[i]
-    node_type = next(iter(n.keys()))
-    v = n[node_type]
-    mesh = mesh_factory(v.get("mesh_index")) if "mesh_index" in v else None
+def linear_color(color):
+    """A "#RRGGBB" color as linear floats, which is what blender's color values are."""
+    return [c / 255 / 12.92 if c / 255 <= 0.04045 else ((c / 255 + 0.055) / 1.055) ** 2.4 for c in ImageColor.getrgb(color)]
+
+
+class Paintjob:
+    """
+    Plane materials which do what set_paintjob.py does in shader nodes, so the
+    colors can be changed in blender without baking new textures.
+
+    Every material uses one node group for the three colors, which are driven
+    by color1, color2 and color3 properties on the plane's root object.
+    """
+    def __init__(self, faction_dir, faction):
+        self.faction = faction
+        self.layers = {set_paintjob.texture_name(t): t for t in faction_dir.rglob("*.bm")}
+        self.group = None
+
+    def _get_image(self, t, layer):
+        path = set_paintjob.layer_path(t, layer)
+        if path.name in bpy.data.images:
+            return bpy.data.images[path.name]
+        with instrument.timer("load_texture", item=path.name):
+            image = bpy.data.images.load(str(path))
+        instrument.count("textures_loaded")
+        instrument.count("bytes_packed", os.path.getsize(path))
+        if layer.startswith("color"):
+            image.colorspace_settings.name = "Non-Color"
+        return image
+
+    def _get_group(self):
+        if self.group is not None:
+            return self.group
+        self.group = bpy.data.node_groups.new("paintjob_colors", "ShaderNodeTree")
+        out = self.group.nodes.new("NodeGroupOutput")
+        for n in range(1, 4):
+            if hasattr(self.group, "interface"):
+                self.group.interface.new_socket(f"color{n}", in_out="OUTPUT", socket_type="NodeSocketColor")
+            else:
+                # blender 3
+                self.group.outputs.new("NodeSocketColor", f"color{n}")
+            rgb = self.group.nodes.new("ShaderNodeRGB")
+            rgb.name = f"color{n}"
+            self.group.links.new(out.inputs[f"color{n}"], rgb.outputs[0])
+        return self.group
+
+    def link(self, material, name):
+        """Tint the base layer of texture name by each color mask, like apply_color_mask, then add the specular layer."""
+        t = self.layers[name]
+        nodes = material.node_tree.nodes
+        links = material.node_tree.links
+        bsdf = nodes["Principled BSDF"]
+
+        tex = {}
+        for layer in set_paintjob.LAYERS:
+            tex[layer] = nodes.new("ShaderNodeTexImage")
+            tex[layer].image = self._get_image(t, layer)
+        colors = nodes.new("ShaderNodeGroup")
+        colors.node_tree = self._get_group()
+
+        output = tex["base"].outputs["Color"]
+        for n in range(1, 4):
+            # white where the mask is black, the color where it's white
+            overlay = nodes.new("ShaderNodeMixRGB")
+            overlay.inputs["Color1"].default_value = (1, 1, 1, 1)
+            links.new(overlay.inputs["Fac"], tex[f"color{n}"].outputs["Color"])
+            links.new(overlay.inputs["Color2"], colors.outputs[f"color{n}"])
+
+            multiply = nodes.new("ShaderNodeMixRGB")
+            multiply.blend_type = "MULTIPLY"
+            multiply.inputs["Fac"].default_value = 1
+            links.new(multiply.inputs["Color1"], output)
+            links.new(multiply.inputs["Color2"], overlay.outputs["Color"])
+            output = multiply.outputs["Color"]
+
+        specular = nodes.new("ShaderNodeMixRGB")
+        links.new(specular.inputs["Fac"], tex["specular"].outputs["Alpha"])
+        links.new(specular.inputs["Color1"], output)
+        links.new(specular.inputs["Color2"], tex["specular"].outputs["Color"])
+        links.new(bsdf.inputs["Base Color"], specular.outputs["Color"])
+
+    def finish(self, obj):
+        """Put the color properties on obj, and a script for switching between factions in the .blend."""
+        if self.group is None: return
+
+        for n, color in enumerate(set_paintjob.FACTION_COLORS[self.faction], 1):
+            prop = f"color{n}"
+            obj[prop] = linear_color(color)
+            obj.id_properties_ui(prop).update(subtype="COLOR", min=0.0, max=1.0)
+            rgb = self.group.nodes[prop]
+            for k in range(3):
+                # a plain single property driver, so no python needs running when the .blend is opened
+                driver = rgb.outputs[0].driver_add("default_value", k).driver
+                driver.type = "AVERAGE"
+                var = driver.variables.new()
+                var.type = "SINGLE_PROP"
+                var.targets[0].id = obj
+                var.targets[0].data_path = f'["{prop}"][{k}]'
+
+        presets = "".join(
+            f"    {faction!r}: {[[round(c, 4) for c in linear_color(color)] for color in colors]!r},\n"
+            for faction, colors in set_paintjob.FACTION_COLORS.items()
+        )
+        text = bpy.data.texts.new("paintjobs.py")
+        text.write(
+            "# Pick a faction and hit Run Script to repaint the plane, or set the\n"
+            "# color1, color2 and color3 properties of its root object by hand.\n"
+            "import bpy\n\n"
+            f"FACTION = {self.faction!r}\n\n"
+            f"PRESETS = {{\n{presets}}}\n\n"
+            f"obj = bpy.data.objects[{obj.name!r}]\n"
+            "for n, color in enumerate(PRESETS[FACTION], 1):\n"
+            "    obj[f\"color{n}\"] = color\n"
+            "obj.update_tag()\n"
+        )
+
+
+def create_object(i, mesh_factory, col):
+    v = graph.nodes[i]
+    mesh = mesh_factory(v.get("mesh_index")) if "mesh_index" in v and i not in emptied else None
     obj = bpy.data.objects.new(v["name"], mesh)
 
     if "transformation" in v and v["transformation"]:
@@ -258,9 +386,6 @@ def create_object_tree(i, mesh_factory, col):
         obj.location = (trans["x"], -trans["z"], trans["y"])
         rot = v["transformation"]["rotation"]
         obj.rotation_euler = (rot["x"], -rot["z"], rot["y"])
-    
-    for ci in v["children"]:
-        create_object_tree(ci, mesh_factory, col).parent = obj
 
     col.objects.link(obj)
 
@@ -268,38 +393,108 @@ def create_object_tree(i, mesh_factory, col):
         # normalize cockpit scale
         obj.scale = (0.03, 0.03, 0.03)
 
-    if v["name"] in ["shadow", "destroyed", "markers", "geometry", "player_damage_on", "pcdp4", "pcdp6"]:
-        hide_recursive(obj)
-    
-    if (v["name"] == "dontmove" or
-        node_type == "Lod" and v["name"] != "nearest"):
-        hide_recursive(obj, lambda c: "static" in c.name or "nosecone" in c.name or "turret" in c.name)
-
     return obj
 
-print("====================================================")
+def create_object_tree(root, mesh_factory, col):
+    objects = {}
+    for i, parent in graph.walk(root, skip=lambda c: c in skipped):
+        objects[i] = create_object(i, mesh_factory, col)
+        if parent is not None:
+            objects[i].parent = objects[parent]
 
-args = sys.argv[sys.argv.index("--") + 1:]
+    for i in prune.hidden_nodes(graph, objects):
+        objects[i].hide_set(True)
 
-data_folder = Path(args[0])
-out_folder = Path(args[1])
-root_node_index = int(args[2])
+    return objects[root]
 
-with ZipFile(str(data_folder / "planes.zip")) as planes:
+print("====================================================")
+
+parser = argparse.ArgumentParser(prog="plane2blend.py")
+parser.add_argument("data_folder", type=Path)
+parser.add_argument("out_folder", type=Path)
+parser.add_argument("root_node_index", type=int)
+prune.add_arguments(parser)
+textures.add_arguments(parser)
+meshdata.add_arguments(parser)
+atlas.add_arguments(parser)
+parser.add_argument(
+    "--paint",
+    metavar="FACTION",
+    type=lambda value: value.upper(),
+    help="Tint the .bm layers of this faction in shader nodes, so the colors can be changed in blender")
+parser.add_argument(
+    "--rof",
+    metavar="FOLDER",
+    type=Path,
+    help="extract_rof.py output folder, for --paint. Defaults to rof_output next to data_folder")
+parser.add_argument(
+    "--report",
+    metavar="FILE",
+    type=Path,
+    help="Save timings and counters to this json file")
+args = parser.parse_args(sys.argv[sys.argv.index("--") + 1:])
+
+data_folder = args.data_folder
+out_folder = args.out_folder
+root_node_index = args.root_node_index
+
+textures.check_tier(data_folder, args.texture_tier)
+
+paintjob = None
+if args.paint:
+    if args.paint not in set_paintjob.FACTION_COLORS:
+        print(f"ERROR: Faction must be one of {', '.join(set_paintjob.FACTION_COLORS.keys())}")
+        exit(1)
+    if args.atlas:
+        print("ERROR: --paint can't be used with --atlas")
+        exit(1)
+    faction_dir = (args.rof or data_folder.parent / "rof_output") / "ASSETS/GRAPHICS" / args.paint
+    if not faction_dir.is_dir():
+        print(f"ERROR: Valid .rof output not found at {faction_dir}")
+        exit(1)
+    paintjob = Paintjob(faction_dir, args.paint)
+
+with instrument.timer("parse_json"), ZipFile(str(data_folder / "planes.zip")) as planes:
     with planes.open("meshes.json") as f:
         meshes_json = json.load(f)
     with planes.open("materials.json") as f:
         materials_json = json.load(f)
     with planes.open("nodes.json") as f:
-        nodes_json = json.load(f)
+        graph = NodeGraph(json.load(f))
 
 for obj in bpy.data.objects:
     bpy.data.objects.remove(obj)
 
-with MaterialFactory.with_tempdir(str(data_folder / "textures.zip"), materials_json) as material_factory:
+skipped, emptied = prune.PrunePolicy.from_args(args).apply(graph)
+
+mesh_indices = atlas.mesh_indices(graph, root_node_index, skipped, emptied)
+
+atlases = None
+if args.atlas:
+    with instrument.timer("atlas"):
+        atlases = atlas.AtlasSet.build(
+            str(textures.tier_path(data_folder, args.texture_tier)), materials_json, meshes_json, mesh_indices,
+            TEXTURE_SUBSTITUTIONS, max_size=args.atlas_size, name=f"{graph.names[root_node_index]}_atlas")
+
+# everything the plane's materials will load themselves, rather than from an atlas or .bm layers
+prefetch = [
+    name for name in materials.used_textures(materials_json, meshes_json, mesh_indices, TEXTURE_SUBSTITUTIONS)
+    if not (atlases and name in atlases.textures or paintjob and name in paintjob.layers)
+]
+
+with MaterialFactory.with_tempdir(
+    str(textures.tier_path(data_folder, args.texture_tier)), materials_json, atlases, paintjob, prefetch
+) as material_factory:
     col = bpy.data.collections["Collection"]
-    mesh_factory = MeshFactory(meshes_json, material_factory)
-    obj = create_object_tree(root_node_index, mesh_factory, col)
+    mesh_factory = MeshFactory(meshes_json, material_factory, args.weld)
+    with instrument.timer("build"):
+        obj = create_object_tree(root_node_index, mesh_factory, col)
+        if paintjob is not None:
+            paintjob.finish(obj)
 
     bpy.data.use_autopack = True
-    bpy.ops.wm.save_as_mainfile(filepath=str(out_folder / f"{obj.name}.blend"))
+    with instrument.timer("save"):
+        bpy.ops.wm.save_as_mainfile(filepath=str(out_folder / f"{obj.name}.blend"))
+
+if args.report:
+    instrument.report.save(args.report)
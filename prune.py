@@ -0,0 +1,94 @@
+"""
+Works out which nodes shouldn't be built at all, before any mesh or material
+gets created for them.
+"""
+
+# children of a pruned lod (or dontmove) which are still wanted, since they're shared between all the lods
+SHARED_PARTS = ["static", "nosecone", "turret"]
+
+# nodes which are only pruned down to the shared parts, like lods
+PARTIAL = ["dontmove"]
+
+# nodes nobody wants to see
+HIDDEN = ["shadow", "destroyed", "markers", "geometry", "player_damage_on", "pcdp4", "pcdp6"]
+
+
+def is_shared_part(name):
+    return any(part in name for part in SHARED_PARTS)
+
+def hidden_nodes(graph, built):
+    """Which of the built nodes of a plane should be hidden rather than shown."""
+    hidden = set()
+    for i in built:
+        name = graph.names[i]
+        if name in HIDDEN:
+            hidden.update(graph.subtree(i, skip=lambda c: c not in built))
+
+        if (name == "dontmove" or
+            graph.types[i] == "Lod" and name != "nearest"):
+            hidden.update(graph.subtree(i, skip=lambda c: c not in built or c != i and is_shared_part(graph.names[c] or "")))
+    return hidden
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--lod",
+        metavar="NAME",
+        help="Only build this level of detail, e.g. nearest")
+    parser.add_argument(
+        "--drop",
+        metavar="NAMES",
+        default=[],
+        type=lambda value: [name for name in value.split(",") if name],
+        help="Comma-separated node names not to build, e.g. shadow,destroyed")
+
+def to_args(args):
+    """Turn parsed arguments back into a command line, for passing on to the blender scripts."""
+    res = []
+    if args.lod is not None:
+        res += ["--lod", args.lod]
+    if args.drop:
+        res += ["--drop", ",".join(args.drop)]
+    return res
+
+
+class PrunePolicy:
+    def __init__(self, lod=None, drop=()):
+        self.lod = lod
+        self.drop = set(drop)
+
+    @classmethod
+    def from_args(cls, args):
+        return cls(args.lod, args.drop)
+
+    def apply(self, graph):
+        """
+        Returns the nodes to skip entirely, and the nodes which are kept
+        as empties (no mesh) so their shared parts still have a parent.
+        """
+        skipped = set()
+        emptied = set()
+
+        for i, name in enumerate(graph.names):
+            if name in self.drop and name not in PARTIAL:
+                skipped.update(graph.subtree(i))
+                continue
+            partial = (
+                name in self.drop or
+                self.lod is not None and graph.types[i] == "Lod" and name != self.lod
+            )
+            if partial:
+                # same rule as hidden_nodes: shared parts stay at any depth, along with their subtree
+                pruned = {}
+                for j, parent in graph.walk(i, skip=lambda c: c != i and is_shared_part(graph.names[c] or "")):
+                    pruned[j] = parent
+                # the nodes between i and a shared part stay as empties so it keeps its parent
+                kept = {i}
+                for j, parent in pruned.items():
+                    if any(is_shared_part(graph.names[ci] or "") for ci in graph.children[j]):
+                        while j is not None and j not in kept:
+                            kept.add(j)
+                            j = pruned[j]
+                emptied.update(kept)
+                skipped.update(j for j in pruned if j not in kept)
+
+        return skipped, emptied
@@ -41,6 +41,18 @@ FACTION_COLORS = {
     "STUDIO": ("#205AA7", "#FFFFFF", "#191919")
 }
 
+# the layers extract_bm.py splits each .bm into
+LAYERS = ["base", "color1", "color2", "color3", "specular"]
+
+def layer_path(t, layer):
+    return t.parent / f"{t.stem}-{layer}.png"
+
+def texture_name(t):
+    """The name in textures.zip of the texture a .bm is for."""
+    if t.stem == "DEV_FUSALAGE1":
+        return "dev_fusalage.png"
+    return f"{t.stem.lower()}.png"
+
 def apply_color_mask(base, mask, color):
     color_fill = Image.new("RGB", mask.size, color)
     white_fill = Image.new("RGB", mask.size, "#ffffff")
@@ -48,90 +60,92 @@ def apply_color_mask(base, mask, color):
     
     return ImageChops.multiply(base, color_overlay)
 
-parser = argparse.ArgumentParser(description="Rewrite plane textures to a different faction")
-parser.add_argument(
-    "plane",
-    type=lambda value: value.upper(),
-    help=", ".join(PLANE_PREFIXES.keys()))
-parser.add_argument(
-    "faction",
-    type=lambda value: value.upper(),
-    help=", ".join(FACTION_COLORS.keys()))
-parser.add_argument(
-    "--data",
-    metavar="FOLDER",
-    dest="data_folder",
-    default=Path("data"),
-    type=lambda value: Path(value).resolve(strict=True),
-    help="Folder with intermediate data")
-parser.add_argument(
-    "--colors",
-    nargs=3,
-    metavar='"#RRGGBB"',
-    help="Override default faction colors")
-
-args = parser.parse_args()
-
-if args.plane not in PLANE_PREFIXES:
-    print(f"ERROR: Plane must be one of {', '.join(PLANE_PREFIXES.keys())}")
-    exit(1)
-
-if args.faction not in FACTION_COLORS:
-    print(f"ERROR: Faction must be one of {', '.join(FACTION_COLORS.keys())}")
-    exit(1)
-
-faction_dir = args.data_folder / "rof_output/ASSETS/GRAPHICS" / args.faction
-if not faction_dir.is_dir():
-    print(f"ERROR: Valid .rof output not found")
-    exit(1)
-
-unzbd_output = args.data_folder / "unzbd_output"
-if not unzbd_output.is_dir():
-    print(f"ERROR: couldn't find unzbd output at {unzbd_output}")
-    exit(1)
-
-if args.colors:
-    try:
-        args.colors = list(map(ImageColor.getrgb, args.colors))
-    except ValueError:
-        print("ERROR: Invalid custom colors")
+def paint_texture(t, colors):
+    """Composite the layers extract_bm.py made from t into a finished texture."""
+    base = Image.open(layer_path(t, "base"))
+    color1_mask = Image.open(layer_path(t, "color1"))
+    color2_mask = Image.open(layer_path(t, "color2"))
+    color3_mask = Image.open(layer_path(t, "color3"))
+    specular = Image.open(layer_path(t, "specular"))
+
+    output = apply_color_mask(base, color1_mask, colors[0])
+    output = apply_color_mask(output, color2_mask, colors[1])
+    output = apply_color_mask(output, color3_mask, colors[2])
+    output = output.convert("RGBA")
+    output = Image.alpha_composite(output, specular)
+    return output.convert("RGB")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rewrite plane textures to a different faction")
+    parser.add_argument(
+        "plane",
+        type=lambda value: value.upper(),
+        help=", ".join(PLANE_PREFIXES.keys()))
+    parser.add_argument(
+        "faction",
+        type=lambda value: value.upper(),
+        help=", ".join(FACTION_COLORS.keys()))
+    parser.add_argument(
+        "--data",
+        metavar="FOLDER",
+        dest="data_folder",
+        default=Path("data"),
+        type=lambda value: Path(value).resolve(strict=True),
+        help="Folder with intermediate data")
+    parser.add_argument(
+        "--colors",
+        nargs=3,
+        metavar='"#RRGGBB"',
+        help="Override default faction colors")
+
+    args = parser.parse_args()
+
+    if args.plane not in PLANE_PREFIXES:
+        print(f"ERROR: Plane must be one of {', '.join(PLANE_PREFIXES.keys())}")
+        exit(1)
+
+    if args.faction not in FACTION_COLORS:
+        print(f"ERROR: Faction must be one of {', '.join(FACTION_COLORS.keys())}")
         exit(1)
 
-plane_prefix = PLANE_PREFIXES[args.plane]
+    faction_dir = args.data_folder / "rof_output/ASSETS/GRAPHICS" / args.faction
+    if not faction_dir.is_dir():
+        print(f"ERROR: Valid .rof output not found")
+        exit(1)
 
-textures = list(faction_dir.rglob(f"{plane_prefix}_*.bm"))
+    unzbd_output = args.data_folder / "unzbd_output"
+    if not unzbd_output.is_dir():
+        print(f"ERROR: couldn't find unzbd output at {unzbd_output}")
+        exit(1)
 
-if not textures:
-    print(f"ERROR: Invalid combination of plane and faction")
-    exit(1)
+    if args.colors:
+        try:
+            args.colors = list(map(ImageColor.getrgb, args.colors))
+        except ValueError:
+            print("ERROR: Invalid custom colors")
+            exit(1)
 
-with ZipFile(unzbd_output / "textures.zip") as z:
-        z.extractall(unzbd_output / "textures")
+    plane_prefix = PLANE_PREFIXES[args.plane]
 
-for t in textures:
-    base = Image.open(t.parent / (t.stem + "-base.png"))
-    color1_mask = Image.open(t.parent / (t.stem + "-color1.png"))
-    color2_mask = Image.open(t.parent / (t.stem + "-color2.png"))
-    color3_mask = Image.open(t.parent / (t.stem + "-color3.png"))
-    specular = Image.open(t.parent / (t.stem + "-specular.png"))
+    textures = list(faction_dir.rglob(f"{plane_prefix}_*.bm"))
 
-    if args.colors:
-        colors = args.colors
-    else:
-        colors = FACTION_COLORS[args.faction]
+    if not textures:
+        print(f"ERROR: Invalid combination of plane and faction")
+        exit(1)
 
-    output = apply_color_mask(base, color1_mask, colors[0])
-    output = apply_color_mask(output, color2_mask, colors[1])
-    output = apply_color_mask(output, color3_mask, colors[2])
-    output = output.convert("RGBA")
-    output = Image.alpha_composite(output, specular)
-    output = output.convert("RGB")
+    with ZipFile(unzbd_output / "textures.zip") as z:
+            z.extractall(unzbd_output / "textures")
 
-    if t.stem == "DEV_FUSALAGE1":
-        t = t.parent / "dev_fusalage.bm"
+    for t in textures:
+        if args.colors:
+            colors = args.colors
+        else:
+            colors = FACTION_COLORS[args.faction]
+
+        output = paint_texture(t, colors)
 
-    with open(unzbd_output / "textures" / f"{t.stem.lower()}.png", "wb") as f:
-        print(f"Saving {t.stem.lower()}.png")
-        output.save(f, format="png")
+        with open(unzbd_output / "textures" / texture_name(t), "wb") as f:
+            print(f"Saving {texture_name(t)}")
+            output.save(f, format="png")
 
-shutil.make_archive(unzbd_output / "textures", "zip", unzbd_output / "textures")
+    shutil.make_archive(unzbd_output / "textures", "zip", unzbd_output / "textures")
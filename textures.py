@@ -0,0 +1,170 @@
+"""
+Helpers for the textures unzbd pulls out of the texture.zbd files.
+
+Run it to make smaller copies of textures.zip for previews:
+
+    > python textures.py data/unzbd_output 2 4
+"""
+import argparse
+import io
+import os.path
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from pathlib import Path
+from zipfile import ZipFile
+
+from PIL import Image
+
+# how many times smaller each tier is, 1 being textures.zip itself
+TIERS = [1, 2, 4, 8]
+
+PREFETCH_THREADS = 4
+
+
+def aggregate_textures(zip_paths, agg_path):
+    """Merge texture zips into one, keeping the first copy of each texture."""
+    with ZipFile(agg_path, "w") as agg_zip:
+        for zip_path in zip_paths:
+            with ZipFile(zip_path) as chapter_zip:
+                for texture_name in chapter_zip.namelist():
+                    if texture_name not in agg_zip.namelist():
+                        agg_zip.writestr(texture_name, chapter_zip.read(texture_name))
+
+def has_alpha(fname):
+    if os.path.isfile(fname):
+        with Image.open(fname) as im:
+            return im.mode == "RGBA" and im.getextrema()[3][0] < 255
+
+class Prefetcher:
+    """
+    Extracts textures and checks them for alpha on a thread pool, so the
+    blender scripts can get on with building meshes in the meantime.
+    """
+    def __init__(self, zip_path, folder, names=(), threads=PREFETCH_THREADS):
+        self.zip_path = zip_path
+        self.folder = Path(folder)
+        # one ZipFile per thread, they don't like being shared
+        self._local = threading.local()
+        self._zips = []
+        self._lock = threading.Lock()
+        self.pool = ThreadPoolExecutor(max_workers=threads)
+        self.futures = {name: self.pool.submit(self._fetch, name) for name in names}
+
+    def _fetch(self, name):
+        if not hasattr(self._local, "zip"):
+            self._local.zip = ZipFile(self.zip_path)
+            with self._lock:
+                self._zips.append(self._local.zip)
+        try:
+            self._local.zip.extract(name, path=str(self.folder))
+        except KeyError:
+            return None
+        path = self.folder / name
+        return path, has_alpha(str(path))
+
+    def get(self, name):
+        """(path, has alpha) for a texture, or None if it isn't in the zip. Waits for it if it isn't ready yet."""
+        if name not in self.futures:
+            self.futures[name] = self.pool.submit(self._fetch, name)
+        return self.futures[name].result()
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+        for z in self._zips:
+            z.close()
+
+def add_arguments(parser):
+    parser.add_argument(
+        "--texture-tier",
+        metavar="N",
+        default=1,
+        type=int,
+        choices=TIERS,
+        help="Use textures this many times smaller, e.g. 4 for quarter size previews. Defaults to 1")
+
+def to_args(args):
+    """Turn parsed arguments back into a command line, for passing on to the export scripts."""
+    return ["--texture-tier", str(args.texture_tier)] if args.texture_tier != 1 else []
+
+def tier_path(folder, tier):
+    """Where the textures of a tier live, next to textures.zip."""
+    return folder / ("textures.zip" if tier == 1 else f"textures_{tier}.zip")
+
+def check_tier(folder, tier):
+    """Quit with an error if a tier's zip hasn't been made yet."""
+    if tier != 1 and not tier_path(folder, tier).is_file():
+        print(f"ERROR: 1/{tier} size textures not found, run python textures.py {folder} {tier}")
+        exit(1)
+
+def downscale(data, factors):
+    """Shrink one png by each factor, returning the new pngs."""
+    with Image.open(io.BytesIO(data)) as im:
+        im.load()
+    if im.mode == "P":
+        im = im.convert("RGBA" if "transparency" in im.info else "RGB")
+
+    # resize with premultiplied alpha, or see-through pixels bleed their color into the edges
+    alpha = im.mode in ("RGBA", "LA")
+    if alpha:
+        im = im.convert("RGBA").convert("RGBa")
+
+    res = []
+    for factor in factors:
+        small = im.resize((max(1, im.width // factor), max(1, im.height // factor)), Image.LANCZOS)
+        if alpha:
+            small = small.convert("RGBA")
+        f = io.BytesIO()
+        small.save(f, format="png")
+        res.append(f.getvalue())
+    return res
+
+def _downscale_member(job):
+    name, data, factors = job
+    return name, downscale(data, factors)
+
+def make_tiers(folder, tiers, jobs=None):
+    """
+    Make the tier zips for textures.zip in folder, resizing in a process pool.
+    Only call this from under __main__, since the pool's workers import the main module.
+    """
+    tiers = [t for t in tiers if t != 1]
+    if not tiers: return
+
+    with ZipFile(tier_path(folder, 1)) as z:
+        work = [(name, z.read(name), tiers) for name in z.namelist()]
+
+    outs = [ZipFile(tier_path(folder, t), "w") for t in tiers]
+    try:
+        with ProcessPoolExecutor(max_workers=jobs) as pool:
+            for name, pngs in pool.map(_downscale_member, work, chunksize=16):
+                for out, png in zip(outs, pngs):
+                    out.writestr(name, png)
+    finally:
+        for out in outs:
+            out.close()
+
+def tiers_stale(folder, tiers):
+    """Which tiers are missing or older than textures.zip, e.g. after set_paintjob.py."""
+    full = tier_path(folder, 1)
+    return [
+        t for t in tiers
+        if t != 1 and (not tier_path(folder, t).is_file() or tier_path(folder, t).stat().st_mtime < full.stat().st_mtime)
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Make smaller copies of textures.zip.")
+    parser.add_argument("folder", type=Path, help="unzbd output folder with textures.zip in it")
+    parser.add_argument("tiers", nargs="+", type=int, choices=TIERS[1:], help="How many times smaller")
+    parser.add_argument(
+        "--jobs",
+        metavar="N",
+        type=int,
+        help="Number of processes to resize with. Defaults to one per CPU")
+    args = parser.parse_args()
+
+    if not tier_path(args.folder, 1).is_file():
+        print(f"ERROR: couldn't find textures.zip in {args.folder}")
+        exit(1)
+
+    make_tiers(args.folder, args.tiers, args.jobs)
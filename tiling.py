@@ -0,0 +1,133 @@
+"""
+Splits a chapter's terrain and misc objects into a grid of tiles.
+
+This doesn't need blender, so everything2blend.py can work out the tiles up
+front and build each one in its own blender process.
+"""
+import json
+import math
+
+# the world object gets scaled down in blender, and the terrain with it
+WORLD_SCALE = 0.03
+
+IDENTITY = ([[1, 0, 0], [0, 1, 0], [0, 0, 1]], [0, 0, 0])
+
+
+def to_blender(x, y, z):
+    return (x, -z, y)
+
+def euler_matrix(rx, ry, rz):
+    # same as blender's XYZ euler order, i.e. Rz @ Ry @ Rx
+    cx, sx = math.cos(rx), math.sin(rx)
+    cy, sy = math.cos(ry), math.sin(ry)
+    cz, sz = math.cos(rz), math.sin(rz)
+    return [
+        [cy * cz, sx * sy * cz - cx * sz, cx * sy * cz + sx * sz],
+        [cy * sz, sx * sy * sz + cx * cz, cx * sy * sz - sx * cz],
+        [-sy, sx * cy, cx * cy],
+    ]
+
+def local_matrix(node_type, v):
+    rot, loc = IDENTITY
+    if v.get("transformation"):
+        t = v["transformation"]["translation"]
+        loc = list(to_blender(t["x"], t["y"], t["z"]))
+        r = v["transformation"]["rotation"]
+        rot = euler_matrix(*to_blender(r["x"], r["y"], r["z"]))
+    if node_type == "World":
+        rot = [[c * WORLD_SCALE for c in row] for row in rot]
+    return rot, loc
+
+def compose(parent, child):
+    prot, ploc = parent
+    crot, cloc = child
+    rot = [[sum(prot[r][k] * crot[k][c] for k in range(3)) for c in range(3)] for r in range(3)]
+    return rot, apply(parent, cloc)
+
+def apply(matrix, p):
+    rot, loc = matrix
+    return [sum(rot[r][k] * p[k] for k in range(3)) + loc[r] for r in range(3)]
+
+def world_matrices(graph):
+    """Object-to-world matrices of every node, as they would end up in blender."""
+    matrices = [None] * len(graph)
+    for i in range(len(graph)):
+        chain = []
+        j = i
+        while j is not None and matrices[j] is None:
+            chain.append(j)
+            j = graph.parents[j]
+        m = IDENTITY if j is None else matrices[j]
+        for k in reversed(chain):
+            m = matrices[k] = compose(m, local_matrix(graph.types[k], graph.nodes[k]))
+    return matrices
+
+def mesh_bounds(mesh):
+    if not mesh or not mesh["vertices"]: return None
+    points = [to_blender(v["x"], v["y"], v["z"]) for v in mesh["vertices"]]
+    return [min(p[a] for p in points) for a in range(3)], [max(p[a] for p in points) for a in range(3)]
+
+def subtree_bounds(i, graph, meshes_json, matrices, mesh_bounds_cache):
+    """World-space bounding box of node i and all its children."""
+    lo = [math.inf] * 3
+    hi = [-math.inf] * 3
+    for j in graph.subtree(i):
+        v = graph.nodes[j]
+        corners = [matrices[j][1]]
+        mesh_index = v.get("mesh_index", -1)
+        if mesh_index is not None and mesh_index >= 0:
+            if mesh_index not in mesh_bounds_cache:
+                mesh_bounds_cache[mesh_index] = mesh_bounds(meshes_json[mesh_index])
+            if b := mesh_bounds_cache[mesh_index]:
+                # the corners of the transformed box are enough, no need to do every vertex
+                corners = [
+                    apply(matrices[j], (x, y, z))
+                    for x in (b[0][0], b[1][0])
+                    for y in (b[0][1], b[1][1])
+                    for z in (b[0][2], b[1][2])
+                ]
+        for p in corners:
+            for a in range(3):
+                lo[a] = min(lo[a], p[a])
+                hi[a] = max(hi[a], p[a])
+    return lo, hi
+
+def tile_units(graph):
+    """The nodes which get sorted into tiles: everything hanging off the world, and the misc roots."""
+    units = [i for i, parent in enumerate(graph.parents) if parent == 0 and i != 0]
+    units += [i for node_type in ["Object3d", "Lod"] for i in graph.by_type.get(node_type, []) if graph.parents[i] is None]
+    # same order as the nodes
+    return sorted(units)
+
+def tile_key(x, y, tile_size):
+    return f"{math.floor(x / tile_size)}_{math.floor(y / tile_size)}"
+
+def compute_tiles(graph, meshes_json, tile_size):
+    """Bucket tile units into a grid of tile_size x tile_size squares by the centre of their bounds."""
+    matrices = world_matrices(graph)
+    mesh_bounds_cache = {}
+    tiles = {}
+    for i in tile_units(graph):
+        lo, hi = subtree_bounds(i, graph, meshes_json, matrices, mesh_bounds_cache)
+        key = tile_key((lo[0] + hi[0]) / 2, (lo[1] + hi[1]) / 2, tile_size)
+        tile = tiles.setdefault(key, {"nodes": [], "bounds": [[math.inf] * 3, [-math.inf] * 3]})
+        tile["nodes"].append(i)
+        tile["bounds"] = [
+            [min(a, b) for a, b in zip(tile["bounds"][0], lo)],
+            [max(a, b) for a, b in zip(tile["bounds"][1], hi)],
+        ]
+    return tiles
+
+def tile_of(tiles):
+    return {i: key for key, tile in tiles.items() for i in tile["nodes"]}
+
+def write_index(path, cname, graph, tiles, tile_size, per_file):
+    index = {"chapter": cname, "tile_size": tile_size, "tiles": {}}
+    for key, tile in sorted(tiles.items()):
+        index["tiles"][key] = {
+            "file": f"{cname}_{key}.blend" if per_file else f"{cname}.blend",
+            "bounds": tile["bounds"],
+            "nodes": [graph.unique_names[i] for i in tile["nodes"]],
+        }
+    with open(path, "w") as f:
+        json.dump(index, f, indent=2)
@@ -1,10 +1,13 @@
 try:    
     import bpy
     import bmesh
+    from mathutils import Matrix, Vector
 except ImportError:
     print("This scripts are supposed to be run inside blender! It's much easier to just run everything2blend.py, which will handle that tricky stuff for you.")
     exit(1)
 
+import argparse
+import gc
 import json
 import os.path
 import sys
@@ -13,49 +16,23 @@ from pathlib import Path
 from tempfile import TemporaryDirectory
 from zipfile import ZipFile
 
-from PIL import Image
-
-TEXTURE_SUBSTITUTIONS = {
-    # higher res textures
-    "agyro_taillogo.png": "12its_logo1.png",
-    "agyro_winglogo.png": "12its_logo1.png",
-    "bal_taillogo.png": "british_tail.png",
-    "bal_winglogo.png": "04british_logo1.png",
-    "blo_taillogo.png": "blake_logo1.png",
-    "blo_winglogo.png": "blake_logo1.png",
-    "bri_taillogo.png": "14medusa_logo1.png",
-    "bri_winglogo.png": "14medusa_logo1.png",
-    "dev_taillogo.png": "fhunter_logo2.png",
-    "dev_winglogo.png": "fhunter_logo4_1.png",
-    "fir_taillogo.png": "10hknights_logo2.png",
-    "fir_winglogo.png": "hollywoodlogo.png",
-    "fur_taillogo.png": "bswan_logo1.png",
-    "fur_winglogo.png": "bswan_logo1.png",
-    "hel_taillogo.png": "sacredtrust_logo1.png",
-    "hel_winglogo.png": "sacredtrust_logo1.png",
-    "kes_taillogo.png": "14medusa_logo1.png",
-    "kes_winglogo.png": "14medusa_logo1.png",
-    "pea_taillogo.png": "blake_logo1.png",
-    "pea_winglogo.png": "blake_logo1.png",
-    "war_taillogo.png": "blackhat_logo1.png",
-    "war_winglogo.png": "blackhat_logo1.png",
-    # these are different textures, but match what's in-game
-    "bal_noselogo.png": "21ace_star.png",
-    "blo_noselogo.png": "21ace_star.png",
-    "bri_noselogo.png": "21ace_star.png",
-    "dev_noselogo.png": "40ohsoblue.png",
-    "fur_noselogo.png": "21ace_star.png",
-    "hel_noselogo.png": "21ace_star.png",
-    "kes_noselogo.png": "21ace_star.png",
-    "pea_noselogo.png": "21ace_star.png",
-    "war_noselogo.png": "21ace_star.png",
-}
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+import instrument
+import materials
+import meshdata
+import prune
+import tiling
+import textures
+from nodegraph import NodeGraph
+
+TEXTURE_SUBSTITUTIONS = materials.LEVEL_TEXTURE_SUBSTITUTIONS
 
 
 class MeshFactory:
-    def __init__(self, meshes_json, material_factory):
+    def __init__(self, meshes_json, material_factory, weld=None):
         self.meshes_json = meshes_json
         self.material_factory = material_factory
+        self.weld = weld
 
     @staticmethod
     def _get_name(mesh_index):
@@ -79,13 +56,17 @@ class MeshFactory:
         uv_layer = bm.loops.layers.uv.new()
         color_layer = bm.loops.layers.color.new("color")
 
-        for v in m["vertices"]:
-            bm.verts.new((v["x"], -v["z"], v["y"]))
+        positions, polygons = meshdata.mesh_positions(m, self.weld)
+        if self.weld is not None:
+            instrument.count("vertices_welded", len(m["vertices"]) - len(positions) // 3, item=self._get_name(mesh_index))
+        for k in range(0, len(positions), 3):
+            bm.verts.new(positions[k : k + 3])
         bm.verts.ensure_lookup_table()
         bm.verts.index_update()
 
-        for poly in m["polygons"]:
-            self._process_poly(bm, poly, uv_layer, color_layer, local_mat_indices)
+        instrument.count("meshes_built")
+        for poly in polygons:
+            self._process_poly(bm, bm.verts, poly, uv_layer, color_layer, local_mat_indices)
 
         assert(len(bm.faces))
         
@@ -96,7 +77,7 @@ class MeshFactory:
         return mesh_data
     
     @staticmethod
-    def _process_poly(bm, poly, uv_layer, color_layer, local_mat_indices):
+    def _process_poly(bm, bm_verts, poly, uv_layer, color_layer, local_mat_indices):
         verts = poly["vertex_indices"]
         colors = poly["vertex_colors"]
         mat_index = poly["materials"][0]["material_index"]
@@ -108,14 +89,16 @@ class MeshFactory:
                 window = verts[i : i + 3]
                 if len(set(window)) != len(window):
                     # ignore tris with duplicate verts
+                    instrument.count("faces_degenerate")
                     continue
                 try:
-                    face = bm.faces.new(bm.verts[i] for i in window)
+                    face = bm.faces.new(bm_verts[i] for i in window)
                     face.smooth = True
                     face.material_index = local_mat_indices[mat_index]
                 except ValueError:
                     # print("WARNING: couldn't create face in triangle strip for some unknown reason")
                     # yeah this happens a lot but the meshes look good so whatever
+                    instrument.count("faces_dropped")
                     continue
 
                 colors_window = colors[i : i + 3]
@@ -128,11 +111,12 @@ class MeshFactory:
         else:
             # Create a single N-gon face
             try:
-                face = bm.faces.new(bm.verts[i] for i in verts)
+                face = bm.faces.new(bm_verts[i] for i in verts)
                 face.smooth = True
                 face.material_index = local_mat_indices[mat_index]
             except ValueError:
                 # print("WARNING: couldn't create face in N-gon for some unknown reason")
+                instrument.count("faces_dropped")
                 return
 
             for index_in_mesh, loop, color in zip(verts, face.loops, colors):
@@ -147,7 +131,87 @@ class MeshFactory:
         if name in bpy.data.meshes:
             return bpy.data.meshes[name]
         else:
-            return self._create_mesh(mesh_index)
+            with instrument.timer("build_mesh", item=name):
+                return self._create_mesh(mesh_index)
+
+
+class MeshBatcher:
+    """
+    Merges the meshes of static nodes into one mesh per material and collection,
+    with their transforms baked in, instead of creating an object for every node.
+    """
+    def __init__(self, meshes_json, material_factory, matrices, weld=None):
+        self.meshes_json = meshes_json
+        self.material_factory = material_factory
+        self.matrices = matrices
+        self.weld = weld
+        self.welded = set()
+        self.batches = {}
+        self.index = {}
+
+    def _get_batch(self, col, mat_index):
+        key = (col.name, mat_index)
+        if key not in self.batches:
+            bm = bmesh.new(use_operators=True)
+            self.batches[key] = {
+                "bm": bm,
+                "uv_layer": bm.loops.layers.uv.new(),
+                "color_layer": bm.loops.layers.color.new("color"),
+                "faces": [],
+            }
+        return self.batches[key]
+
+    def add_subtree(self, i, col):
+        for j in graph.subtree(i, skip=lambda c: c in skipped):
+            v = graph.nodes[j]
+            if v.get("mesh_index", -1) != -1 and j not in emptied:
+                self.add_mesh(graph.unique_names[j], v["mesh_index"], self.matrices[j], col)
+
+    def add_mesh(self, name, mesh_index, matrix, col):
+        if not (m := self.meshes_json[mesh_index]) or not m["polygons"]: return
+        rot, loc = matrix
+        matrix = Matrix([rot[0] + [loc[0]], rot[1] + [loc[1]], rot[2] + [loc[2]], [0, 0, 0, 1]])
+
+        positions, polygons = meshdata.mesh_positions(m, self.weld)
+        if self.weld is not None and mesh_index not in self.welded:
+            self.welded.add(mesh_index)
+            instrument.count("vertices_welded", len(m["vertices"]) - len(positions) // 3, item=MeshFactory._get_name(mesh_index))
+        polys_by_material = {}
+        for poly in polygons:
+            polys_by_material.setdefault(poly["materials"][0]["material_index"], []).append(poly)
+
+        for mat_index, polys in polys_by_material.items():
+            batch = self._get_batch(col, mat_index)
+            bm = batch["bm"]
+            bm_verts = [bm.verts.new(matrix @ Vector(positions[k : k + 3])) for k in range(0, len(positions), 3)]
+            first_face = len(bm.faces)
+            for poly in polys:
+                MeshFactory._process_poly(bm, bm_verts, poly, batch["uv_layer"], batch["color_layer"], {mat_index: 0})
+            batch["faces"].append((name, first_face, len(bm.faces)))
+
+    def finish(self):
+        """Turn the batches into objects, and return which faces came from which node."""
+        for (col_name, mat_index), batch in self.batches.items():
+            bm = batch["bm"]
+            # every node adds all its verts to each of its materials' batches, so drop the unused ones
+            bmesh.ops.delete(bm, geom=[v for v in bm.verts if not v.link_faces], context="VERTS")
+            if not len(bm.faces):
+                bm.free()
+                continue
+
+            material = self.material_factory(mat_index)
+            name = f"batch_{col_name}_{material.name}"
+            mesh_data = bpy.data.meshes.new(name=name)
+            mesh_data.materials.append(material)
+            bmesh.ops.recalc_face_normals(bm, faces=bm.faces)
+            bm.to_mesh(mesh_data)
+            bm.free()
+            mesh_data.attributes.active_color_index = 0
+
+            obj = bpy.data.objects.new(name, mesh_data)
+            bpy.data.collections[col_name].objects.link(obj)
+            self.index[obj.name] = batch["faces"]
+        return self.index
 
 
 class MaterialFactory:
@@ -157,54 +221,48 @@ class MaterialFactory:
         cls,
         textures,
         materials_json,
+        prefetch=(),
     ):
         with TemporaryDirectory() as tempdir:
-            yield cls(textures, materials_json, Path(tempdir))
+            factory = cls(textures, materials_json, Path(tempdir), prefetch)
+            try:
+                yield factory
+            finally:
+                factory.prefetcher.close()
 
     def __init__(
         self,
         textures_zip,
         materials_json,
         tempdir,
+        prefetch=(),
     ):
         self.tempdir = Path(tempdir)
-        self.textures_zip = ZipFile(textures_zip)
+        # textures get extracted in the background while meshes are built
+        self.prefetcher = textures.Prefetcher(textures_zip, self.tempdir, prefetch)
         self.materials_json = materials_json
-
-    @staticmethod
-    def has_alpha(fname):
-        if os.path.isfile(fname):
-            with Image.open(fname) as im:
-                return im.mode == "RGBA" and im.getextrema()[3][0] < 255
     
     def _get_image(self, texture_name):
         if texture_name in bpy.data.images:
             return bpy.data.images[texture_name]
-        try:
-            self.textures_zip.extract(texture_name, path=str(self.tempdir))
-            return bpy.data.images.load(str(self.tempdir / texture_name))
-        except KeyError:
-            print("WARNING: did not find", texture_name)
+        with instrument.timer("load_texture", item=texture_name):
+            if (fetched := self.prefetcher.get(texture_name)) is None:
+                print("WARNING: did not find", texture_name)
+                return None
+            image = bpy.data.images.load(str(fetched[0]))
+        instrument.count("textures_loaded")
+        # these all get packed into the .blend when it's saved
+        instrument.count("bytes_packed", os.path.getsize(fetched[0]))
+        return image
         
     def _get_name(self, i):
-        m = self.materials_json[i]
-        if "Colored" in m: return f"material_{i}"
-        
-        tif_name = m["Textured"]["texture"]
-
-        # some textures have spurious segments like bldhwk_cowling.5.tif which can be ignored
-        if len(parts := tif_name.split(".")) > 2:
-            tif_name = parts[0] + "." + parts[-1]
-
-        png_name = os.path.splitext(tif_name.lower())[0] + ".png"
-
-        # get a better texture if we have one
-        return TEXTURE_SUBSTITUTIONS.get(png_name, png_name)
+        return materials.material_name(self.materials_json, i, TEXTURE_SUBSTITUTIONS)
 
     def _create_material(self, mat_index):
         name = self._get_name(mat_index)
         m = materials_json[mat_index]
         material = bpy.data.materials.new(name)
+        instrument.count("materials_created")
         material.use_nodes = True
         bsdf = material.node_tree.nodes["Principled BSDF"]
 
@@ -223,7 +281,7 @@ class MaterialFactory:
             tex.image = image
             material.node_tree.links.new(bsdf.inputs["Base Color"], tex.outputs["Color"])
 
-            if self.has_alpha(str(self.tempdir / name)):
+            if self.prefetcher.get(name)[1]:
                 material.node_tree.links.new(bsdf.inputs["Alpha"], tex.outputs["Alpha"])
                 material.blend_method = "BLEND"
                 material.shadow_method = "CLIP"
@@ -241,77 +299,299 @@ class MaterialFactory:
             return self._create_material(mat_index)
         
 
-def hide_recursive(obj, except_condition = lambda c: False):
-    obj.hide_set(True)
-    for c in obj.children:
-        if not except_condition(c):
-            hide_recursive(c, except_condition)
-
-def create_object_tree(i, mesh_factory, col):
-    n = nodes_json[i]
-    v = next(iter(n.values()))
-    node_type = v["type"]
-    mesh = mesh_factory(v.get("mesh_index")) if "mesh_index" in v else None
+class StreamWriter:
+    """
+    Keeps memory use down while building a level, by dropping the json of meshes
+    which won't be needed again, and whenever memory use goes over budget, saving
+    what's been built so far to a part .blend and removing it from this one. The
+    main .blend links all the parts back in at the end.
+    """
+    # how many units to build between parts when we can't tell how much memory we're using
+    FALLBACK_UNITS = 500
+
+    def __init__(self, out_path, budget_mb, meshes_json, mesh_uses):
+        self.out_path = out_path
+        self.budget = budget_mb * 1024 * 1024
+        self.limit = self.budget
+        self.meshes_json = meshes_json
+        # how many more nodes are going to use each mesh
+        self.mesh_uses = mesh_uses
+        # names of the objects which stay in the main .blend
+        self.keep = set()
+        self.parts = []
+        self.units = 0
+
+    def built(self, nodes):
+        """Call after building a unit, with the nodes that were built."""
+        for i in nodes:
+            # emptied nodes didn't get counted, they don't use their mesh
+            if i in emptied: continue
+            mesh_index = graph.nodes[i].get("mesh_index", -1)
+            if mesh_index in self.mesh_uses:
+                self.mesh_uses[mesh_index] -= 1
+                if not self.mesh_uses[mesh_index]:
+                    self.meshes_json[mesh_index] = None
+
+        self.units += 1
+        if (used := instrument.memory_usage()) is None:
+            if self.units % self.FALLBACK_UNITS == 0:
+                self.flush()
+        elif used > self.limit:
+            self.flush()
+            # blender doesn't always give memory back, so don't end up saving a part after every unit
+            self.limit = max(self.budget, instrument.memory_usage() + self.budget // 4)
+
+    def flush(self):
+        objs = [obj for obj in bpy.data.objects if obj.name not in self.keep]
+        if not objs: return
+        n = len(self.parts)
+
+        # the part gets a copy of each collection its objects are in, to link back into the real one
+        part_cols = {}
+        for obj in objs:
+            for col in obj.users_collection:
+                name = f"{col.name}_part{n:03}"
+                if name not in part_cols:
+                    part_cols[name] = bpy.data.collections.new(name)
+                part_cols[name].objects.link(obj)
+
+        path = self.out_path.parent / f"{self.out_path.name}_part{n:03}.blend"
+        with instrument.timer("write_part"):
+            bpy.ops.file.pack_all()
+            bpy.data.libraries.write(str(path), set(part_cols.values()), fake_user=True)
+        instrument.count("parts_written")
+        print(f"Saved {len(objs)} objects to {path.name}")
+
+        meshes = {obj.data for obj in objs if obj.data is not None}
+        for obj in objs:
+            bpy.data.objects.remove(obj)
+        for col in part_cols.values():
+            bpy.data.collections.remove(col)
+        for mesh in meshes:
+            if not mesh.users:
+                bpy.data.meshes.remove(mesh)
+        gc.collect()
+        self.parts.append((path, list(part_cols)))
+
+    def link_parts(self):
+        """Link the parts' collections into the collections they came from. Needs the main .blend saved first, for relative paths."""
+        for path, names in self.parts:
+            with bpy.data.libraries.load(str(path), link=True, relative=True) as (data_from, data_to):
+                data_to.collections = names
+            for col in data_to.collections:
+                bpy.data.collections[col.name.rsplit("_part", 1)[0]].children.link(col)
+
+
+# these don't make sense in blender
+IGNORED_TYPES = ["Window", "Display", "Camera", "Light"]
+
+def get_collection(i, col):
+    node_type = graph.types[i]
 
     if node_type == "World":
-        v["name"] = "world"
         col = bpy.data.collections["world"]
-    elif node_type == "Terrain":
+    elif node_type == "Terrain" or i in detached_terrain:
         col = bpy.data.collections["terrain"]
-    elif v.get("parent") is None and node_type in ["Object3d", "Lod"]:
+    elif graph.parents[i] is None and node_type in ["Object3d", "Lod"]:
         col = bpy.data.collections["misc"]
-    elif node_type in ["Window", "Display", "Camera", "Light"]:
-        return None
-    
-    obj = bpy.data.objects.new(v["name"], mesh)
+
+    if i in tile_of:
+        col = get_tile_collection(col, tile_of[i])
+    return col
+
+def create_object(i, mesh_factory, col):
+    v = graph.nodes[i]
+    node_type = graph.types[i]
+    mesh = mesh_factory(v.get("mesh_index")) if "mesh_index" in v and i not in emptied else None
+    obj = bpy.data.objects.new("world" if node_type == "World" else graph.unique_names[i], mesh)
 
     if "transformation" in v and v["transformation"]:
         trans = v["transformation"]["translation"]
         obj.location = (trans["x"], -trans["z"], trans["y"])
         rot = v["transformation"]["rotation"]
         obj.rotation_euler = (rot["x"], -rot["z"], rot["y"])
-    
-    for ci in v["children"]:
-        create_object_tree(ci, mesh_factory, col).parent = obj
-    
+
     col.objects.link(obj)
 
-    if node_type == "World": obj.scale = (0.03, 0.03, 0.03)
+    if node_type == "World": obj.scale = (tiling.WORLD_SCALE,) * 3
 
     return obj
 
+def should_skip(i):
+    return (
+        i in skipped or
+        i in batch_roots or
+        graph.types[i] in IGNORED_TYPES or
+        not in_selected_tile(i)
+    )
+
+def create_object_tree(root, mesh_factory, col):
+    objects = {}
+    cols = {None: col}
+    for i, parent in graph.walk(root, skip=should_skip):
+        cols[i] = get_collection(i, cols[parent])
+        objects[i] = create_object(i, mesh_factory, cols[i])
+        if parent is not None:
+            objects[i].parent = objects[parent]
+    return objects.get(root)
+
+def stream_units():
+    """The subtrees a streamed build is made of: everything hanging off the world, and the other roots."""
+    units = []
+    for root in graph.roots:
+        if root == 0:
+            units += graph.children[0] + sorted(detached_terrain)
+        else:
+            units.append(root)
+    return units
+
+def build_streamed(mesh_factory, stream, units):
+    world_col = None
+    if not should_skip(0):
+        world_col = get_collection(0, None)
+        stream.keep.add(create_object(0, mesh_factory, world_col).name)
+
+    for unit in units:
+        parent_col = world_col if graph.parents[unit] == 0 else None
+        if graph.parents[unit] == 0 and world_col is None: continue
+        obj = create_object_tree(unit, mesh_factory, parent_col)
+        if obj is not None and graph.parents[unit] == 0:
+            # parts can't point back at the world object in the main .blend, so bake its transform in
+            rot, loc = matrices[unit]
+            obj.matrix_world = Matrix([rot[0] + [loc[0]], rot[1] + [loc[1]], rot[2] + [loc[2]], [0, 0, 0, 1]])
+        stream.built(i for i, _ in graph.walk(unit, skip=should_skip))
+
+def get_tile_collection(col, key):
+    name = f"{col.name}_{key}"
+    if name not in bpy.data.collections:
+        col.children.link(bpy.data.collections.new(name))
+    return bpy.data.collections[name]
+
+def get_batch_collection(i):
+    # what the collection would have been if we'd made objects all the way down
+    chain = []
+    j = i
+    while j is not None:
+        chain.append(j)
+        j = graph.parents[j] if j not in detached_terrain else None
+    col = None
+    for j in reversed(chain):
+        col = get_collection(j, col)
+    return col
+
+def in_selected_tile(i):
+    return args.tile is None or tile_of.get(i, args.tile) == args.tile
+
+def is_static(i):
+    node_type = graph.types[i]
+    if node_type not in ["Object3d", "Terrain", "Lod"]:
+        return False
+    # all the lods would be merged on top of each other, unless the others have been pruned
+    if node_type == "Lod" and args.lod is None:
+        return False
+    # nodes the game can move or change at runtime
+    flags = graph.nodes[i].get("flags") or []
+    return not any("modify" in str(flag).lower() for flag in flags)
+
+def find_batch_roots():
+    """The largest subtrees under terrain and misc which only contain static nodes."""
+    units = [i for i in tiling.tile_units(graph) if i not in skipped and in_selected_tile(i)]
+    order = [j for i in units for j in graph.subtree(i, skip=lambda c: c in skipped)]
+
+    # children always come after their parents in order, so go backwards
+    static = {}
+    for i in reversed(order):
+        static[i] = is_static(i) and all(static[ci] for ci in graph.children[i] if ci not in skipped)
+
+    # don't go below a batch root, everything under it is already in its batch
+    batch_roots = set()
+    stack = list(units)
+    while stack:
+        i = stack.pop()
+        if static[i]:
+            batch_roots.add(i)
+        else:
+            stack.extend(ci for ci in graph.children[i] if ci not in skipped)
+    return batch_roots
+
 print("====================================================")
 
 # & "C:\Program Files\Blender Foundation\Blender 3.5\blender.exe" --background --factory-startup --python-use-system-env --python world2blend.py -- "C:/Users/roz/Documents/crimson/extracted" "C:/Users/roz/Documents/crimson/planetoblend/world_out"
 
-args = sys.argv[sys.argv.index("--") + 1:]
+parser = argparse.ArgumentParser(prog="world2blend.py")
+parser.add_argument("data_folder", type=Path)
+parser.add_argument("out_folder", type=Path)
+parser.add_argument("cname")
+parser.add_argument(
+    "--tile-size",
+    type=float,
+    help="Sort terrain and misc objects into square tiles of this size")
+parser.add_argument(
+    "--tile",
+    metavar="KEY",
+    help="Only build this tile, e.g. 0_-1, and save it to its own file")
+parser.add_argument(
+    "--batch",
+    action="store_true",
+    help="Merge static terrain and misc meshes into one mesh per material")
+parser.add_argument(
+    "--stream",
+    metavar="MB",
+    type=int,
+    help="Keep memory use under about this many megabytes, by saving parts of the level to their own .blends as they're finished")
+prune.add_arguments(parser)
+textures.add_arguments(parser)
+meshdata.add_arguments(parser)
+parser.add_argument(
+    "--report",
+    metavar="FILE",
+    type=Path,
+    help="Save timings and counters to this json file")
+args = parser.parse_args(sys.argv[sys.argv.index("--") + 1:])
+
+if args.tile is not None and args.tile_size is None:
+    print("ERROR: --tile needs --tile-size")
+    exit(1)
+
+if args.stream is not None and args.batch:
+    print("ERROR: --stream can't be used with --batch, which keeps everything until the end")
+    exit(1)
+
+data_folder = args.data_folder
+out_folder = args.out_folder
+cname = args.cname
 
-data_folder = Path(args[0])
-out_folder = Path(args[1])
-cname = args[2]
+textures.check_tier(data_folder, args.texture_tier)
 
-with ZipFile(str(data_folder / f"{cname}.zip")) as gamez:
+with instrument.timer("parse_json"), ZipFile(str(data_folder / f"{cname}.zip")) as gamez:
     with gamez.open("meshes.json") as f:
         meshes_json = json.load(f)
     with gamez.open("materials.json") as f:
         materials_json = json.load(f)
     with gamez.open("nodes.json") as f:
-        nodes_json = json.load(f)
+        graph = NodeGraph(json.load(f))
 
 for obj in bpy.data.objects:
     bpy.data.objects.remove(obj)
 
-roots = []
-for i, n in enumerate(nodes_json):
-    node_type = next(iter(n.keys()))
-    v = n[node_type]
-    v["type"] = node_type
-    v["index"] = i
-    if "name" in v:
-        # node names aren't unique!
-        v["name"] = v["name"] + f"_{i:04}"
-    if v.get("parent") is None:
-        roots.append(i)
+# the world node doesn't actually have its terrain in children *eyeroll*
+# so we have to add them manually
+detached_terrain = set(graph.detached_children(0))
+
+skipped, emptied = prune.PrunePolicy.from_args(args).apply(graph)
+
+tile_of = {}
+if args.tile_size is not None:
+    tiles = tiling.compute_tiles(graph, meshes_json, args.tile_size)
+    tile_of = tiling.tile_of(tiles)
+    if args.tile is None:
+        tiling.write_index(out_folder / f"{cname}_tiles.json", cname, graph, tiles, args.tile_size, per_file=False)
+    elif args.tile not in tiles:
+        print(f"ERROR: no tile {args.tile} in {cname}")
+        exit(1)
+
+batch_roots = find_batch_roots() if args.batch else set()
+matrices = tiling.world_matrices(graph)
 
 col = bpy.data.collections["Collection"]
 world_col = bpy.data.collections.new("world")
@@ -321,20 +601,57 @@ col.children.link(misc_col)
 terrain_col = bpy.data.collections.new("terrain")
 col.children.link(terrain_col)
 
-with MaterialFactory.with_tempdir(str(data_folder / "textures.zip"), materials_json) as material_factory:
-    mesh_factory = MeshFactory(meshes_json, material_factory)
-    for i, root_index in enumerate(roots):
-        obj = create_object_tree(root_index, mesh_factory, None)
-        if obj is None: continue
-    
-    # the world node doesn't actually have its terrain in children *eyeroll*
-    # so we have to add them manually
-    for i, n in enumerate(nodes_json):
-        v = next(iter(n.values()))
-        if v.get("name", "world") not in bpy.data.objects and v.get("parent") == 0:
-            v["type"] = "Terrain"
-            obj = create_object_tree(i, mesh_factory, world_col)
-            obj.parent = bpy.data.objects["world"]
+mesh_indices = [
+    graph.nodes[i]["mesh_index"] for i in range(len(graph))
+    if graph.nodes[i].get("mesh_index", -1) != -1 and i not in skipped and i not in emptied and in_selected_tile(i)
+]
+prefetch = materials.used_textures(materials_json, meshes_json, mesh_indices, TEXTURE_SUBSTITUTIONS)
+
+with MaterialFactory.with_tempdir(
+    str(textures.tier_path(data_folder, args.texture_tier)), materials_json, prefetch
+) as material_factory:
+    mesh_factory = MeshFactory(meshes_json, material_factory, args.weld)
+    batcher = MeshBatcher(meshes_json, material_factory, matrices, args.weld)
+    out_name = cname if args.tile is None else f"{cname}_{args.tile}"
+
+    with instrument.timer("batch"):
+        for i in batch_roots:
+            batcher.add_subtree(i, get_batch_collection(i))
+
+    with instrument.timer("build"):
+        if args.stream is None:
+            root_objects = {}
+            for root_index in graph.roots:
+                root_objects[root_index] = create_object_tree(root_index, mesh_factory, None)
+
+            for i in detached_terrain:
+                if obj := create_object_tree(i, mesh_factory, world_col):
+                    obj.parent = root_objects[0]
+        else:
+            units = stream_units()
+            mesh_uses = {}
+            for unit in units:
+                for i, _ in graph.walk(unit, skip=should_skip):
+                    if (mesh_index := graph.nodes[i].get("mesh_index", -1)) != -1 and i not in emptied:
+                        mesh_uses[mesh_index] = mesh_uses.get(mesh_index, 0) + 1
+            stream = StreamWriter(out_folder / out_name, args.stream, meshes_json, mesh_uses)
+            build_streamed(mesh_factory, stream, units)
+
+    if args.batch:
+        with instrument.timer("batch"):
+            batch_index = batcher.finish()
+        # keep track of which faces came from which node, in the .blend and next to it
+        with open(out_folder / f"{out_name}_batches.json", "w") as f:
+            json.dump(batch_index, f, indent=2)
+        text = bpy.data.texts.new("batches.json")
+        text.write(json.dumps(batch_index, indent=2))
 
     bpy.data.use_autopack = True
-    bpy.ops.wm.save_as_mainfile(filepath=str(out_folder / f"{cname}.blend"))
+    with instrument.timer("save"):
+        bpy.ops.wm.save_as_mainfile(filepath=str(out_folder / f"{out_name}.blend"))
+        if args.stream is not None and stream.parts:
+            stream.link_parts()
+            bpy.ops.wm.save_mainfile()
+
+if args.report:
+    instrument.report.save(args.report)